@@ -0,0 +1,376 @@
+"""
+    A local stand-in for the parts of Google Drive that gdvfs uses, for
+    benchmarking without network noise or quota.
+
+    The server emulates:
+
+      * ``files().list`` with ``'<id>' in parents`` queries (including several
+        OR-combined parents) and paging, at ``/drive/v2/files``
+      * ``changes().getStartPageToken`` and ``changes().list``, at
+        ``/drive/v2/changes``, reporting the files changed with ``update`` and
+        ``delete``
+      * ``get_video_info`` responses, at ``/get_video_info``
+      * range-capable video streams, at ``/videoplayback``, whose URLs stop
+        working with a 403 once they expire
+
+    Every response is delayed by ``latency`` seconds, and video data is sent
+    at no more than ``bandwidth`` bytes per second per connection.
+"""
+import BaseHTTPServer
+import httplib
+import json
+import re
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+
+from apiclient import errors
+import httplib2
+
+FOLDER_MIMETYPE = "application/vnd.google-apps.folder"
+MODIFIED_DATE   = "2015-07-28T16:33:27.240599Z"
+
+# Alternate videos of each video, as ``(itag, width, height, type, quality, bytes)``
+VARIANTS = [
+    ("37", 1920, 1080, "video/mp4; codecs=\"avc1.64001F, mp4a.40.2\"", "hd1080", 48*1024*1024),
+    ("22", 1280, 720,  "video/mp4; codecs=\"avc1.64001F, mp4a.40.2\"", "hd720",  24*1024*1024),
+    ("18", 640,  360,  "video/mp4; codecs=\"avc1.42001E, mp4a.40.2\"", "medium", 8*1024*1024),
+]
+
+# Video data is a repeating pattern, so that any range can be served cheaply
+PATTERN         = "".join([chr(i % 251) for i in range(251*1024)])
+CHUNK_SIZE      = 64*1024
+
+def make_tree(nodes, fanout=20, videos=0.2):
+    """
+    Returns a tree of about ``nodes`` files and folders, as a dict of folder id
+    to the file resources of its children.  Each folder has up to ``fanout``
+    children, of which a fraction of ``videos`` are videos.
+    """
+    tree    = {"root": []}
+    folders = ["root"]
+    count   = 0
+    while count < nodes:
+        parent = folders.pop(0)
+        for i in range(fanout):
+            if count >= nodes:
+                break
+            count += 1
+            id = "n%d" % count
+            if i % fanout < int(fanout*videos):
+                item = {
+                    "id":                   id,
+                    "title":                "video %d.mkv" % count,
+                    "mimeType":             "video/x-matroska",
+                    "fileExtension":        "mkv",
+                    "fileSize":             str(1024*1024*1024),
+                    "videoMediaMetadata":   {"width": 1920, "height": 1080},
+                    "downloadUrl":          "",
+                }
+            elif i % 2:
+                item = {
+                    "id":                   id,
+                    "title":                "folder %d" % count,
+                    "mimeType":             FOLDER_MIMETYPE,
+                }
+                tree[id] = []
+                folders.append(id)
+            else:
+                item = {
+                    "id":                   id,
+                    "title":                "file %d.txt" % count,
+                    "mimeType":             "text/plain",
+                    "fileExtension":        "txt",
+                    "fileSize":             "1024",
+                }
+            item.update({
+                "createdDate":  MODIFIED_DATE,
+                "modifiedDate": MODIFIED_DATE,
+                "parents":      [{"id": parent, "isRoot": parent == "root"}]
+            })
+            tree[parent].append(item)
+
+        if not folders:
+            break
+
+    return tree
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # Headers are written a line at a time, which would otherwise be delayed
+    disable_nagle_algorithm = True
+
+    PARENTS_RE = re.compile(r"'([^']+)' in parents")
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url    = urlparse.urlsplit(self.path)
+        query  = dict(urlparse.parse_qsl(url.query))
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if url.path == "/drive/v2/files":
+            self.list_files(query)
+        elif url.path == "/drive/v2/changes/startPageToken":
+            self.get_start_page_token()
+        elif url.path == "/drive/v2/changes":
+            self.list_changes(query)
+        elif url.path == "/get_video_info":
+            self.get_video_info(query)
+        elif url.path == "/videoplayback":
+            self.videoplayback(query)
+        else:
+            self.send_status(404)
+
+    def send_status(self, code):
+        self.server.count("status_%d" % code)
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_body(self, body, type):
+        self.send_response(200)
+        self.send_header("Content-Type", type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Set-Cookie", "DRIVE_STREAM=bench")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def list_files(self, query):
+        self.server.count("files_list")
+
+        items = []
+        with self.server._lock:
+            for id in self.PARENTS_RE.findall(query.get("q", "")):
+                items.extend(self.server.tree.get(id, []))
+
+        start   = int(query.get("pageToken") or 0)
+        count   = int(query.get("maxResults") or 100)
+        result  = {"items": items[start:start+count]}
+        if start+count < len(items):
+            result["nextPageToken"] = str(start+count)
+
+        self.send_body(json.dumps(result), "application/json")
+
+    def get_start_page_token(self):
+        self.server.count("changes_start")
+
+        with self.server._lock:
+            token = str(len(self.server.changes))
+        self.send_body(json.dumps({"startPageToken": token}), "application/json")
+
+    def list_changes(self, query):
+        self.server.count("changes_list")
+
+        token   = query.get("pageToken", "")
+        count   = int(query.get("maxResults") or 100)
+        with self.server._lock:
+            valid = token.isdigit() and int(token) <= len(self.server.changes)
+            if valid:
+                start  = int(token)
+                result = {"items": self.server.changes[start:start+count]}
+                if start+count < len(self.server.changes):
+                    result["nextPageToken"] = str(start+count)
+                else:
+                    result["newStartPageToken"] = str(len(self.server.changes))
+
+        if not valid:
+            # Unknown page token
+            self.send_status(400)
+            return
+
+        self.send_body(json.dumps(result), "application/json")
+
+    def get_video_info(self, query):
+        self.server.count("get_video_info")
+
+        docid    = query.get("docid", "")
+        expire   = int(time.time() + self.server.url_ttl)
+        fmt_list = []
+        streams  = []
+        for itag, width, height, type, quality, bytes in VARIANTS:
+            fmt_list.append("%s/%dx%d/9/0/115" % (itag, width, height))
+            url = "%s/videoplayback?%s" % (self.server.url, urllib.urlencode([
+                ("id", docid), ("itag", itag), ("expire", expire)]))
+            streams.append(urllib.urlencode([("itag", itag), ("url", url), ("type", type), ("quality", quality)]))
+
+        self.send_body(urllib.urlencode([
+            ("status",                      "ok"),
+            ("fmt_list",                    ",".join(fmt_list)),
+            ("url_encoded_fmt_stream_map",  ",".join(streams)),
+        ]), "application/x-www-form-urlencoded")
+
+    def videoplayback(self, query):
+        if int(query.get("expire", 0)) < time.time():
+            self.send_status(403)
+            return
+
+        sizes = dict([(v[0], v[5]) for v in VARIANTS])
+        size  = sizes.get(query.get("itag"))
+        if size is None:
+            self.send_status(404)
+            return
+
+        start, end = 0, size-1
+        rng = self.headers.get("Range")
+        if rng:
+            first, last = rng.split("=", 1)[1].split("-")
+            start = int(first)
+            if last:
+                end = min(int(last), size-1)
+            if start >= size:
+                self.send_status(416)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+        else:
+            self.send_response(200)
+
+        self.send_header("Content-Length", str(end-start+1))
+        self.end_headers()
+        self.server.count("videoplayback")
+
+        # Stop early if the client goes away, e.g. after seeking elsewhere
+        offset = start
+        try:
+            while offset <= end:
+                length = min(CHUNK_SIZE, end-offset+1)
+                self.wfile.write(expected_data(offset, length))
+                offset += length
+                if self.server.bandwidth:
+                    time.sleep(float(length)/self.server.bandwidth)
+        finally:
+            self.server.count("video_bytes", offset-start)
+
+class FakeDrive(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, tree, latency=0, bandwidth=0, url_ttl=3600):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), Handler)
+        self.tree       = tree
+        self.latency    = latency
+        self.bandwidth  = bandwidth
+        self.url_ttl    = url_ttl
+        self.url        = "http://127.0.0.1:%d" % self.server_address[1]
+        self.counts     = {}
+        self.changes    = []
+
+        self._lock      = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def _detach(self, id):
+        for children in self.tree.values():
+            children[:] = [c for c in children if c["id"] != id]
+
+    def update(self, item):
+        """
+        Adds or replaces the file resource ``item``, in the folders listed in its
+        ``parents``, and reports it in the changes feed.
+        """
+        with self._lock:
+            self._detach(item["id"])
+            for parent in item["parents"]:
+                self.tree[parent["id"]].append(item)
+            if item["mimeType"] == FOLDER_MIMETYPE:
+                self.tree.setdefault(item["id"], [])
+            self.changes.append({"fileId": item["id"], "deleted": False, "file": item})
+
+    def delete(self, id):
+        """
+        Removes a file, and reports it in the changes feed.
+        """
+        with self._lock:
+            self._detach(id)
+            self.changes.append({"fileId": id, "deleted": True})
+
+    def handle_error(self, request, client_address):
+        # Clients closing streams early is expected
+        pass
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever, name="fakedrive")
+        t.daemon = True
+        t.start()
+
+def expected_data(offset, length):
+    """
+    Returns the video data the server sends for the given range.
+    """
+    begin = offset % len(PATTERN)
+    data  = PATTERN[begin:] + PATTERN[:begin]
+    while len(data) < length:
+        data += data
+    return data[:length]
+
+class Service(object):
+    """
+    Just enough of the Drive API client to list files from a ``FakeDrive``.
+    A new connection is used for each thread.
+    """
+
+    def __init__(self, url):
+        self.url    = url
+        self._local = threading.local()
+
+    def files(self):
+        return self
+
+    def list(self, **param):
+        return Request(self, "/drive/v2/files?" + urllib.urlencode(param))
+
+    def changes(self):
+        return Changes(self)
+
+    def request(self, path):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = httplib.HTTPConnection(urlparse.urlsplit(self.url).netloc)
+        conn.request("GET", path)
+        res = conn.getresponse()
+        return res.status, res.read(), dict(res.getheaders())
+
+class Changes(object):
+    def __init__(self, service):
+        self.service    = service
+
+    def getStartPageToken(self):
+        return Request(self.service, "/drive/v2/changes/startPageToken")
+
+    def list(self, **param):
+        return Request(self.service, "/drive/v2/changes?" + urllib.urlencode(param))
+
+class Request(object):
+    def __init__(self, service, path):
+        self.service    = service
+        self.path       = path
+
+    def execute(self):
+        status, body, headers = self.service.request(self.path)
+        if status >= 400:
+            raise errors.HttpError(httplib2.Response({"status": status}), body)
+        return json.loads(body)
+
+class Http(object):
+    """
+    Stands in for ``httplib2.Http``, returning ``(response, content)`` from
+    ``request`` with the response headers in lower case.
+    """
+
+    def __init__(self, service):
+        self.service = service
+
+    def request(self, url, method="GET"):
+        parts = urlparse.urlsplit(url)
+        status, body, headers = self.service.request(parts.path + "?" + parts.query)
+        headers["status"] = str(status)
+        return headers, body
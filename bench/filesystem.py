@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+"""
+    Benchmark of gdvfs file system operations against a local fake Drive.
+
+    Usage: python bench/filesystem.py [options]
+
+    The tree is walked twice, cold and then warm, with `readdir` on every
+    folder and `getattr` on every entry.  Some of the alternate videos found
+    are then read sequentially and at random offsets.
+
+    With ``-o sync_changes=True``, some files are then renamed on the fake
+    Drive, and the changes feed is polled to check that the renames show up
+    in listings without the folders being listed again.
+
+    Options:
+        -n, --nodes=<count>     Number of files and folders in the tree (1000)
+        --fanout=<count>        Number of children of each folder (20)
+        --videos=<fraction>     Fraction of the children that are videos (0.2)
+        --latency=<ms>          Delay of every request to the fake Drive (50)
+        --bandwidth=<MB/s>      Bandwidth of each video stream, 0 for no limit (0)
+        --url-ttl=<seconds>     Time after which video URLs expire (3600)
+        --read-files=<count>    Number of videos to read (4)
+        --read-size=<MB>        Amount of each video to read sequentially (16)
+        --read-length=<KB>      Size of each read (128)
+        --seeks=<count>         Number of reads at random offsets per video (20)
+        --changes=<count>       Number of files renamed with sync_changes (50)
+        -o <option>=<value>     Sets a gdvfs configuration option
+"""
+import ConfigParser
+import getopt
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import gdvfs
+import fakedrive
+
+class Credentials(object):
+    access_token    = "bench"
+    invalid         = False
+
+class Timings(object):
+    """
+    Records the latency of each call of each operation.
+    """
+
+    def __init__(self):
+        self.times  = {}
+        self.order  = []
+
+    def call(self, name, fn, *args):
+        start = time.time()
+        try:
+            return fn(*args)
+        finally:
+            if not self.times.has_key(name):
+                self.times[name] = []
+                self.order.append(name)
+            self.times[name].append(time.time()-start)
+
+    def report(self):
+        print "%-18s %8s %9s %9s %9s %9s %9s %9s" % (
+            "operation", "count", "total s", "ops/s", "p50 ms", "p90 ms", "p99 ms", "max ms")
+        for name in self.order:
+            times = sorted(self.times[name])
+            total = sum(times)
+            print "%-18s %8d %9.2f %9.0f %9.2f %9.2f %9.2f %9.2f" % (
+                name, len(times), total, len(times)/total if total else 0,
+                percentile(times, 50)*1000, percentile(times, 90)*1000,
+                percentile(times, 99)*1000, times[-1]*1000)
+
+def percentile(times, p):
+    return times[int(round((len(times)-1)*p/100.0))]
+
+def mount(server, options, tmp):
+    """
+    Returns a ``GDVFS`` instance whose Drive requests go to ``server``.
+    """
+    config = ConfigParser.SafeConfigParser(gdvfs.CONFIG_DEFAULT)
+    config.add_section(gdvfs.CONFIG_SECTION)
+    config.set(gdvfs.CONFIG_SECTION, "oath_storage", os.path.join(tmp, "auth"))
+    config.set(gdvfs.CONFIG_SECTION, "changes_state", os.path.join(tmp, "changes"))
+    for name, value in options:
+        config.set(gdvfs.CONFIG_SECTION, name, value)
+
+    service = fakedrive.Service(server.url)
+
+    drive = gdvfs.Drive(config)
+    drive._creds        = Credentials()
+    drive.get_service   = lambda: service
+    drive.get_http      = lambda: fakedrive.Http(service)
+    drive.VIDEO_INFO_URL = server.url + "/get_video_info?docid=%s"
+
+    fs = gdvfs.GDVFS(drive)
+    fs("init", "/")
+    return fs
+
+def walk(fs, timings, label):
+    """
+    Lists every folder and stats every entry, returning the paths of the
+    alternate videos found.
+    """
+    videos  = []
+    folders = ["/"]
+    while folders:
+        path = folders.pop(0)
+        for name in timings.call("readdir (%s)" % label, fs, "readdir", path, 0):
+            if name in (".", ".."):
+                continue
+
+            child = os.path.join(path, name)
+            st    = timings.call("getattr (%s)" % label, fs, "getattr", child)
+            if st["st_mode"] & 0040000:
+                folders.append(child)
+            elif path.endswith(".mkv") and not name.endswith(".mkv"):
+                videos.append((child, st["st_size"]))
+
+    return videos
+
+def read(fs, timings, videos, read_size, read_length, seeks):
+    """
+    Reads each video sequentially and then at random offsets, and returns the
+    number of bytes read.
+    """
+    total = 0
+    for path, size in videos:
+        fh = timings.call("open", fs, "open", path, os.O_RDONLY)
+        try:
+            offset = 0
+            while offset < min(read_size, size):
+                data = timings.call("read (sequential)", fs, "read", path, read_length, offset, fh)
+                if offset == 0 and data != fakedrive.expected_data(0, len(data)):
+                    raise Exception("Unexpected data read from %s" % path)
+                offset += len(data)
+                total  += len(data)
+
+            for i in range(seeks):
+                offset = random.randrange(0, max(size-read_length, 1))
+                data   = timings.call("read (random)", fs, "read", path, read_length, offset, fh)
+                if data != fakedrive.expected_data(offset, len(data)):
+                    raise Exception("Unexpected data read from %s at %d" % (path, offset))
+                total += len(data)
+        finally:
+            timings.call("release", fs, "release", path, fh)
+
+    return total
+
+def sync(fs, server, timings, count):
+    """
+    Renames ``count`` files on the server, polls the changes feed and checks
+    that the new titles are listed.  Returns the number of folders listed
+    while doing so.
+    """
+    files = [(parent, item) for parent, children in server.tree.items() for item in children
+             if item["mimeType"] != fakedrive.FOLDER_MIMETYPE]
+    renamed = random.sample(files, min(count, len(files)))
+    for parent, item in renamed:
+        item = dict(item, title="renamed %s" % item["title"])
+        server.update(item)
+
+    paths   = {"root": "/"}
+    folders = ["root"]
+    while folders:
+        id = folders.pop(0)
+        for item in server.tree[id]:
+            if item["mimeType"] == fakedrive.FOLDER_MIMETYPE:
+                paths[item["id"]] = os.path.join(paths[id], item["title"])
+                folders.append(item["id"])
+
+    before = server.counts.get("files_list", 0)
+    timings.call("changes poll", fs.drive._changes.poll)
+
+    for parent, item in renamed:
+        path = paths[parent]
+        if "renamed %s" % item["title"] not in timings.call("readdir (synced)", fs, "readdir", path, 0):
+            raise Exception("Rename of %s not listed in %s" % (item["title"], path))
+
+    return server.counts.get("files_list", 0) - before
+
+def usage():
+    print __doc__
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:o:", ["help", "nodes=", "fanout=", "videos=",
+                                                           "latency=", "bandwidth=", "url-ttl=",
+                                                           "read-files=", "read-size=", "read-length=",
+                                                           "seeks=", "changes="])
+    except getopt.GetoptError, e:
+        print str(e)
+        usage()
+        sys.exit(2)
+
+    nodes       = 1000
+    fanout      = 20
+    videos      = 0.2
+    latency     = 50
+    bandwidth   = 0
+    url_ttl     = 3600
+    read_files  = 4
+    read_size   = 16
+    read_length = 128
+    seeks       = 20
+    changes     = 50
+    options     = []
+
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ("-n", "--nodes"):
+            nodes = int(arg)
+        elif opt == "--fanout":
+            fanout = int(arg)
+        elif opt == "--videos":
+            videos = float(arg)
+        elif opt == "--latency":
+            latency = float(arg)
+        elif opt == "--bandwidth":
+            bandwidth = float(arg)
+        elif opt == "--url-ttl":
+            url_ttl = int(arg)
+        elif opt == "--read-files":
+            read_files = int(arg)
+        elif opt == "--read-size":
+            read_size = int(arg)
+        elif opt == "--read-length":
+            read_length = int(arg)
+        elif opt == "--seeks":
+            seeks = int(arg)
+        elif opt == "--changes":
+            changes = int(arg)
+        elif opt == "-o":
+            options.append(arg.split("=", 1))
+
+    random.seed(0)
+    server = fakedrive.FakeDrive(fakedrive.make_tree(nodes, fanout, videos), latency/1000.0,
+                                 bandwidth*1024*1024, url_ttl)
+    server.start()
+
+    tmp = tempfile.mkdtemp(prefix="gdvfs-bench-")
+    try:
+        fs      = mount(server, options, tmp)
+        timings = Timings()
+
+        start = time.time()
+        found = walk(fs, timings, "cold")
+        print "Walked %d nodes in %.2f seconds, found %d videos" % (nodes, time.time()-start, len(found))
+        walk(fs, timings, "warm")
+
+        start = time.time()
+        total = read(fs, timings, found[:read_files], read_size*1024*1024, read_length*1024, seeks)
+        elapsed = time.time()-start
+        if total:
+            print "Read %.1f MB in %.2f seconds, %.1f MB/s" % (total/1048576.0, elapsed, total/1048576.0/elapsed)
+
+        if fs.drive._changes and changes:
+            listed = sync(fs, server, timings, changes)
+            print "Synced %d renames, listing %d folders" % (changes, listed)
+
+        print
+        timings.report()
+        print
+        print "Requests: %s" % ", ".join(["%s=%d" % i for i in sorted(server.counts.items())])
+
+        fs("destroy", "/")
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+    Micro-benchmark of the get_video_info parser.
+
+    Usage: python bench/parser.py [-n <number>] [response file ...]
+
+    Each given file should hold a recorded get_video_info response.  If none
+    are given, a synthetic response shaped like those returned by Google is
+    used.
+"""
+import getopt
+import os
+import sys
+import time
+import timeit
+import urllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import gdvfs
+
+FORMATS = [
+    ("37", "1920x1080", "video/mp4; codecs=\"avc1.64001F, mp4a.40.2\"", "hd1080"),
+    ("22", "1280x720",  "video/mp4; codecs=\"avc1.64001F, mp4a.40.2\"", "hd720"),
+    ("59", "854x480",   "video/mp4; codecs=\"avc1.4d001f, mp4a.40.2\"", "large"),
+    ("18", "640x360",   "video/mp4; codecs=\"avc1.42001E, mp4a.40.2\"", "medium"),
+    ("43", "640x360",   "video/webm; codecs=\"vp8.0, vorbis\"",         "medium"),
+    ("5",  "320x240",   "video/x-flv",                                  "small"),
+]
+
+def make_response(docid="0B-synthetic-docid"):
+    """
+    Returns a response with the same structure, and roughly the same size, as
+    a real one.
+    """
+    expire   = int(time.time()) + 6*3600
+    fmt_list = []
+    urls     = []
+    streams  = []
+    for i, (itag, size, type, quality) in enumerate(FORMATS):
+        fmt_list.append("%s/%s/9/0/115" % (itag, size))
+        url = ("https://r%d---sn-4g5e6nl7.c.drive.google.com/videoplayback?id=%s"
+               "&itag=%s&source=webdrive&requiressl=yes&mm=30&mn=sn-4g5e6nl7&ms=nxu"
+               "&mv=m&pl=24&ttl=transient&ei=8hnYVfmKLs3-qQXZm7KIBA&driveid=%s"
+               "&mime=%s&lmt=1438101207240599&mt=1440225617&ip=0.0.0.0&ipbits=0"
+               "&expire=%d&sparams=ip,ipbits,expire,id,itag,source,requiressl,ttl"
+               "&signature=4D2C6E7A3F7B1C0D2E5A9B8C7D6E5F4A3B2C1D0E.1A2B3C4D5E6F7A8B9C0D1E2F3A4B5C6D7E8F9A0B"
+               "&key=ck2") % (i, docid[:16], itag, docid, urllib.quote(type.split(";")[0]), expire)
+        urls.append("%s|%s" % (itag, url))
+        streams.append(urllib.urlencode([("itag", itag), ("url", url), ("type", type), ("quality", quality)]))
+
+    # Besides the formats, responses include the same URLs in "fmt_stream_map"
+    # and many fields for the player, which the parser has to skip over
+    storyboard = "|".join(["https://lh3.googleusercontent.com/storyboard/%s/M%d.jpg?sigh=%s" % (docid, i, "x"*40)
+                           for i in range(20)])
+    return urllib.urlencode([
+        ("status",                      "ok"),
+        ("token",                       "AJ1gU5bSF3LjW8nH0rTtdQfM7xFUqP2JEg"),
+        ("title",                       "Synthetic Video.mkv"),
+        ("length_seconds",              "5400"),
+        ("fmt_list",                    ",".join(fmt_list)),
+        ("fmt_stream_map",              ",".join(urls)),
+        ("url_encoded_fmt_stream_map",  ",".join(streams)),
+        ("storyboard_spec",             storyboard),
+        ("iurl",                        "https://drive.google.com/vt?id=%s&s=AMedNnoAAAAAVdhIuA" % docid),
+        ("timestamp",                   str(int(time.time()))),
+        ("ttsurl",                      "https://docs.google.com/timedtext?id=%s&vid=%s&expire=%d" % (docid, docid, expire)),
+        ("account_playback_token",      "QUFFLUhqbTVyM2J2cXhqMnNjZ0p5c1ZBd3pqZkRBbHVfd3xBQ3Jtc0tuQ2dkcEVqZ0xHNlM"),
+    ])
+
+def usage():
+    print __doc__
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:", ["help"])
+    except getopt.GetoptError, e:
+        print str(e)
+        usage()
+        sys.exit(2)
+
+    number = 10000
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt == "-n":
+            number = int(arg)
+
+    responses = [("synthetic", make_response())]
+    if args:
+        responses = [(os.path.basename(path), open(path).read()) for path in args]
+
+    parser = gdvfs.VideoInfoParser(gdvfs.CONFIG_DEFAULT["include_formats"])
+    for name, data in responses:
+        videos  = parser.parse(data)
+        best    = min(timeit.repeat(lambda: parser.parse(data), repeat=3, number=number))
+        print "%-20s %6d bytes %3d videos %8.1f us/parse %9.0f parses/s" % (
+            name, len(data), len(videos), best/number*1e6, number/best)
+
+if __name__ == "__main__":
+    main()
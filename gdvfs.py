@@ -5,22 +5,34 @@
 """
 # Standard library modules
 import calendar
+import collections
 import ConfigParser
+import datetime
 import errno
+import fnmatch
 import getopt
+import httplib
+import json
 import logging
 import os
+import Queue
 import re
+import shutil
+import socket
+import sqlite3
+import StringIO
 import sys
 import thread
 import threading
 import time
+import traceback
 import urllib
 import urllib2
+import urlparse
 
 # Google stuff
 from apiclient import errors
-from apiclient.discovery import build
+from apiclient.discovery import build, build_from_document
 import httplib2
 from oauth2client.client import FlowExchangeError, OAuth2WebServerFlow
 from oauth2client.file import Storage
@@ -54,7 +66,48 @@ CONFIG_DEFAULT  = {
     "allow_root":       "False",
     "local":            "False",
     "volicon":          "",
-    "lookup_threads":   "True"
+    "lookup_threads":   "True",
+    "cache_memory":     "64",
+    "cache_block_size": "1024",
+    "cache_dir":        "",
+    "cache_disk_size":  "1024",
+    "readahead":        "True",
+    "readahead_time":   "10",
+    "readahead_max":    "32",
+    "download_connections":  "1",
+    "download_segment_size": "4",
+    "seek_window":      "2048",
+    "reorder_blocks":   "4",
+    "pool_connections": "8",
+    "pool_idle_timeout": "60",
+    "cache_max_stale":  "600",
+    "refresh_threads":  "4",
+    "prewarm_interval": "0",
+    "sync_changes":     "False",
+    "changes_interval": "30",
+    "changes_state":    "~/.gdvfs.changes",
+    "metadata_db":      "",
+    "negative_cache_size": "10000",
+    "negative_cache_time": "60",
+    "lookup_pool_size": "8",
+    "size_cache":       "",
+    "url_renew_margin": "300",
+    "url_cache_time":   "3600",
+    "expand_videos":    "False",
+    "expand_threads":   "4",
+    "batch_folders":    "20",
+    "metrics_file":     "",
+    "metrics_interval": "60",
+    "profile_duration": "10",
+    "profile_interval": "5",
+    "profile_dir":      "",
+    "slow_op_threshold": "0",
+    "discovery_cache":  "~/.gdvfs.discovery",
+    "discovery_cache_time": "604800",
+    "client_pool_size": "16",
+    "client_idle_timeout": "300",
+    "token_refresh_margin": "300",
+    "ignore_patterns":  ""
 }
 
 def full_path_split(path):
@@ -93,6 +146,7 @@ class Node:
         self.title    = title
         self.parent   = parent
         self.updated  = 0
+        self.version  = 0
         self.attribs  = {}
         self.children = {}
         self.mtime    = 0
@@ -101,9 +155,25 @@ class Node:
 
         self._drive   = drive
 
+        # The file resource this node was last set from, used to tell whether
+        # it has changed
+        self._item    = None
+
+        # Held while refreshing, so that concurrent requests for a stale node
+        # wait for a single refresh rather than each doing their own
+        self._lock    = TimedLock("node", drive.metrics)
+
     def __getitem__(self, key):
         return self.children.get(key, None)
 
+    def get_fs_path(self):
+        """
+        Returns the path of this node within the mounted file system.
+        """
+        if self.parent is None:
+            return "/"
+        return os.path.join(self.parent.get_fs_path(), self.title)
+
     def get_path(self):
         paths = []
         node  = self
@@ -117,15 +187,20 @@ class Node:
             self.update()
 
         if self.video_attribs and not self.video_attribs.has_key("bytes"):
-            log.debug("Getting file size for video: %s" % self.title)
-            hdrs = {
-                'Authorization': 'Bearer %s' % self._drive._creds.access_token,
-                'Cookie': self._drive._cookies
-            }
-            req  = urllib2.Request(self.video_attribs.get("url"), None, hdrs)
-            res  = urllib2.urlopen(req)
+            sizes = self._drive._sizes
+            key   = (self.id, self.video_attribs.get("itag"), self.get_modified_time())
+            size  = sizes.get(*key) if sizes else None
+
+            if size is None:
+                log.debug("Getting file size for video: %s" % self.title)
+                size = self._drive.get_content_length(self.video_attribs.get("url"))
+                if sizes:
+                    sizes.put(*(key + (size,)))
+
+            self.video_attribs["bytes"] = size
 
-            self.video_attribs["bytes"] = int(res.headers.get("content-length", 0))
+            if self._drive._store:
+                self._drive._store.save_video_attribs(self)
 
         if self.video_attribs and self.video_attribs.has_key("bytes"):
             bytes = self.video_attribs["bytes"]
@@ -158,6 +233,26 @@ class Node:
                 node.mtime = mtime
             node = node.parent
 
+    def get_cache_key(self):
+        """
+        Returns a ``(docid, variant)`` tuple that identifies the stream of bytes
+        served by this node.  Alternate encodes share the docid of the original
+        video, so the variant is needed to tell them apart.
+        """
+        if self.video_attribs:
+            return (self.id, self.video_attribs.get("itag"))
+        return (self.id, "original")
+
+    def get_modified_time(self):
+        """
+        Returns the modification time of the file this node represents, as
+        reported by Google, or ``0`` if it isn't known.
+        """
+        modified = self.attribs.get("modifiedDate")
+        if modified:
+            return get_timestamp(modified)
+        return 0
+
     def get_video_url(self):
         if self.video_attribs:
             return self.video_attribs.get("url", "")
@@ -167,15 +262,90 @@ class Node:
         self.update()
         return self.children
 
+    def get_cache_time(self):
+        if self._drive._changes and self._drive._changes.is_synced(self.updated) and \
+                not self.attribs.has_key("videoMediaMetadata"):
+            # Folders are kept up to date by the changes feed
+            return float("inf")
+        if self.parent is None:
+            return self._drive.ROOT_CACHE_TIME
+        return self._drive.CACHE_TIME
+
+    def is_fresh(self):
+        return self.updated > 0 and time.time()-self.updated < self.get_cache_time()
+
     def update(self):
         """
         Get all children of this node.
+
+        Data that has expired, but by no more than ``cache_max_stale`` seconds,
+        is still used and the node is refreshed in the background.
         """
-        if time.time()-self.updated < self._drive.CACHE_TIME:
+        if self.is_fresh():
             # Use the cached data
-            log.debug("Using cached data for node: %s" % self.title)
+            log.debug("Using cached data for node: %s", self.title)
+            return
+
+        if self.updated and time.time()-self.updated < self.get_cache_time()+self._drive.MAX_STALE_TIME:
+            # Use the stale data for now
+            log.debug("Using stale data for node: %s", self.title)
+            self._drive.schedule_refresh(self)
             return
 
+        self.refresh()
+
+    def refresh(self, force=False):
+        """
+        Refreshes this node, unless it is refreshed by another thread while we
+        wait for the lock.  If this node has never been loaded, it is loaded from
+        the metadata store instead, if possible.
+        """
+        with self._lock:
+            if not force and self.is_fresh():
+                # Another thread refreshed this node while we were waiting
+                log.debug("Using data refreshed by another thread for node: %s" % self.title)
+                return
+
+            if not self.updated and self._load():
+                return
+
+            self._refresh()
+
+    def _load(self):
+        """
+        Loads this node's children from the metadata store.  Unless the changes
+        feed is keeping the stored data up to date, the node is then refreshed
+        in the background.  Returns ``True`` if stored data was found.
+        """
+        if not self._drive._store:
+            return False
+
+        stored = self._drive._store.load(self.id)
+        if stored is None:
+            return False
+
+        updated, rows = stored
+        log.debug("Loaded %d stored children for node: %s" % (len(rows), self.title))
+
+        children = {}
+        for id, title, attribs, video_attribs in rows:
+            node = Node(id, title, self, self._drive, video_attribs)
+            node.attribs = attribs
+            try:
+                node._update_mtime(get_timestamp(attribs.get("modifiedDate")))
+            except:
+                log.error("Couldn't update mtime")
+            children[title] = node
+
+        self._replace_children(children)
+        self.updated  = updated or 1
+
+        if not updated or not (self._drive._changes and self._drive._changes.is_synced(updated)):
+            self._drive.schedule_refresh(self, True)
+
+        return True
+
+    def _refresh(self):
         log.debug("Refreshing data for node: %s" % self.title)
 
         service     = self._drive.get_service()
@@ -186,8 +356,9 @@ class Node:
         if self.attribs.has_key("videoMediaMetadata"):
             # This is a video, not a directory
 
-            # Remove all videos
-            self.children.clear()
+            # The children are rebuilt from scratch and swapped in once complete,
+            # so that other threads never see a partial listing
+            children = {}
 
             # Check for current alternate videos
             videos = self._drive.get_urls_for_docid(self.id)
@@ -199,38 +370,35 @@ class Node:
                 use_threads = self._drive._config.getboolean(CONFIG_SECTION, "lookup_threads")
 
                 # Add the alternate formats
-                threads = []
+                tasks = []
                 for video in videos:
                     title = "%s-%sp.%s" % (base_title, video.get("height"), video.get("extension").lower())
-                    if not self.children.has_key(title):
+                    if not children.has_key(title):
                         # If this is a new video, add it
                         log.debug("Adding child: %s" % title)
 
                         # Create the new node
-                        self.children[title] = Node(self.id, title, self, self._drive, video)
-                        self.children[title].attribs = self.attribs.copy()
-                        self.children[title]._update_mtime(get_timestamp(self.attribs.get("modifiedDate")))
+                        children[title] = Node(self.id, title, self, self._drive, video)
+                        children[title].attribs = self.attribs.copy()
+                        children[title]._update_mtime(get_timestamp(self.attribs.get("modifiedDate")))
 
                         # We need to change the mimetype and bytes so that this node
                         # appears as a video and not a directory
-                        self.children[title].attribs.update({
+                        children[title].attribs.update({
                             "mimeType": self.attribs.get("originalMimeType")
                         })
-                        self.children[title].attribs.pop("bytes", 0)
+                        children[title].attribs.pop("bytes", 0)
 
-                        # XXX: Testing threaded lookups.  In my testing, this is roughly
-                        #      2.5x faster than the non-threaded version.
+                        # Look up the sizes concurrently, on a pool of threads shared
+                        # by all videos
                         if use_threads:
-                            log.debug("Starting lstat thread")
-                            t = threading.Thread(target=self.children[title].lstat)
-                            t.start()
-                            threads.append(t)
+                            tasks.append(self._drive._lookup_pool.submit(children[title].lstat))
 
                 if use_threads:
-                    # Wait for all threads to finish
-                    log.debug("Waiting for lstat threads")
-                    for t in threads:
-                      t.join()
+                    # Wait for all lookups to finish
+                    log.debug("Waiting for %d size lookups" % len(tasks))
+                    for task in tasks:
+                        task.wait()
 
             # See if we need to include the original video
             include_original = False
@@ -245,13 +413,15 @@ class Node:
 
             if include_original:
                 log.debug("Adding original video")
-                self.children[self.title] = Node(self.id, self.title, self, self._drive)
-                self.children[self.title].attribs = self.attribs.copy()
-                self.children[self.title].attribs.update({
+                children[self.title] = Node(self.id, self.title, self, self._drive)
+                children[self.title].attribs = self.attribs.copy()
+                children[self.title].attribs.update({
                     "mimeType": self.attribs.get("originalMimeType"),
                     "fileSize": self.attribs.get("originalfileSize")
                 })
-                self.children[self.title]._update_mtime(get_timestamp(self.attribs.get("modifiedDate")))
+                children[self.title]._update_mtime(get_timestamp(self.attribs.get("modifiedDate")))
+
+            self._replace_children(children)
 
         else:
             # This is a directory
@@ -269,7 +439,8 @@ class Node:
                         param['pageToken'] = page_token
 
                     try:
-                        files = service.files().list(**param).execute()
+                        with self._drive.metrics.timer("api.files_list"):
+                            files = service.files().list(**param).execute()
                     except Exception, e:
                         log.error("Error: %s" % str(e))
                         continue
@@ -283,54 +454,193 @@ class Node:
                     log.error('An error occurred: %s' % error)
                     break
 
-            # List of titles of all children, as reported by Google
-            all_children = [n['title'] for n in results]
+            self._reconcile(results)
 
-            # Now add or update the children
-            for child in results:
-                if self.children.has_key(child["title"]):
-                    # Update
-                    self.children[child["title"]].id    = child["id"]
-                    self.children[child["title"]].title = child["title"]
-                else:
-                    # Add
-                    self.children[child["title"]] = Node(child["id"], child["title"], self, self._drive)
+        self.updated = time.time()
+        self.version += 1
 
-                node = self.children[child["title"]]
+        if self._drive._store:
+            self._drive._store.save(self)
 
-                # Set the attributes for this node
-                node.attribs = child.copy()
+    def _reconcile(self, items):
+        """
+        Brings the children of this folder in line with ``items``, the files
+        listed in it by the Drive API.  Children are matched to items by file
+        id, so renamed children keep their node (and anything loaded below it),
+        and only children that have been added, removed, renamed or changed are
+        touched.
+        """
+        titles   = self._get_titles(items)
+        existing = {}
+        for node in self.children.values():
+            existing[node.id] = node
+
+        for item in items:
+            title = titles[item["id"]]
+            node  = existing.pop(item["id"], None)
+
+            if node is None:
+                log.debug("Adding child: %s" % title)
+                self._set_child(item, title=title)
+            elif node.title != title:
+                log.info("Renaming child: %s -> %s" % (node.title, title))
+                if self.children.get(node.title) is node:
+                    self._remove_child(node.title)
+                self._set_child(item, node, title)
+            elif node._item != item:
+                self._set_child(item, node, title)
+
+        # Remove any children that are no longer present
+        for node in existing.values():
+            if self.children.get(node.title) is node:
+                log.info("Removing child: %s" % node.title)
+                self._remove_child(node.title)
+
+    def _get_titles(self, items):
+        """
+        Returns a map of file id to the title to show each item as.  Drive
+        allows several files in a folder to have the same title, so all but the
+        oldest of them are shown with part of their id appended.
+        """
+        by_title = {}
+        for item in items:
+            by_title.setdefault(item["title"], []).append(item)
+
+        titles = {}
+        for title, duplicates in by_title.iteritems():
+            if len(duplicates) > 1:
+                duplicates.sort(key=lambda i: (i.get("createdDate"), i["id"]))
+                base, ext = os.path.splitext(title)
+                for item in duplicates[1:]:
+                    titles[item["id"]] = "%s (%s)%s" % (base, item["id"][:8], ext)
+            titles[duplicates[0]["id"]] = title
+
+        return titles
+
+    def _retitle(self, title, item=None):
+        """
+        Shows the children that have ``title`` on Drive the way ``_reconcile``
+        would, after one of them has been added, removed or renamed by a single
+        change.  ``item`` is the file resource of a child being added or
+        updated, and the title it is to be shown as is returned.  Must be called
+        with ``_lock`` held.
+        """
+        nodes = []
+        items = []
+        for node in self.children.values():
+            node_item = node._item or node.attribs
+            if node_item.get("title") == title and (item is None or node.id != item["id"]):
+                nodes.append(node)
+                items.append(node_item)
+
+        if item is not None:
+            items.append(item)
+
+        titles  = self._get_titles(items)
+        renamed = [n for n in nodes if n.title != titles[n.id]]
+
+        # Detach them all first, so that they can swap titles
+        for node in renamed:
+            if self.children.get(node.title) is node:
+                self._remove_child(node.title)
+
+        for node in renamed:
+            log.info("Renaming child: %s -> %s" % (node.title, titles[node.id]))
+            node.title = titles[node.id]
+            self.children[node.title] = node
+            self._drive.index(node)
+
+        if renamed:
+            self.version += 1
+
+        if item is not None:
+            return titles[item["id"]]
+
+    def _remove_child(self, title):
+        node = self.children.get(title)
+        if node is not None:
+            self._drive.unindex(node)
+            self.children.pop(title, None)
+        return node
+
+    def _replace_children(self, children):
+        for node in self.children.values():
+            self._drive.unindex(node)
+
+        self.children = children
+        self.version += 1
+
+        for node in children.values():
+            self._drive.index(node)
+
+    def _set_child(self, item, node=None, title=None):
+        """
+        Adds or updates the child described by ``item``, a file resource from
+        the Drive API, and returns its node.  An existing ``node`` may be given
+        to re-attach it to this folder, e.g. when it has been moved or renamed.
+        The child is shown as ``title``, if given, rather than its own title.
+        """
+        if title is None:
+            title = item["title"]
 
-                # Update the mtime for all children
-                try:
-                    node._update_mtime(get_timestamp(node.attribs.get("modifiedDate")))
-                except:
-                    log.error("Couldn't update mtime")
-
-                # If the "videoMediaMetadata" key is present, then this is a video
-                video_exts = [v.strip() for v in self._drive._config.get(CONFIG_SECTION, "video_extensions").lower().split(",")]
-                if node.attribs.has_key("videoMediaMetadata") or node.attribs.get("fileExtension") in video_exts:
-                    # Since this is a video, we need to do a few things:
-                    #   (1) Change this node from a video to a directory
-                    #   (2) Add this video as a child to the directory node
-                    #   (3) Add alternate videos as children to the directory node
-
-                    # Turn this video into a directory
-                    node.attribs.update({
-                        "originalMimeType": child.get("mimeType"),
-                        "originalFileSize": child.get("fileSize"),
-                        "fileSize":         self.FOLDER_BYTES,
-                        "mimeType":         self.FOLDER_MIMETYPE
-                    })
+        if node is None:
+            node = self.children.get(title)
 
-                else:
-                    # Remove any children that are no longer present
-                    for title in self.children.keys():
-                        if title not in all_children:
-                            log.info("Removing child: %s" % title)
-                            self.children.pop(title)
+        if node is not None:
+            # Update
+            moved = (node.id, node.title, node.parent) != (item["id"], title, self)
+            if moved:
+                self._drive.unindex(node)
 
-        self.updated = time.time()
+            node.id     = item["id"]
+            node.title  = title
+            node.parent = self
+        else:
+            # Add
+            node  = Node(item["id"], title, self, self._drive)
+            moved = True
+
+        old = self.children.get(title)
+        if old is not None and old is not node:
+            self._drive.unindex(old)
+
+        self.children[title] = node
+
+        if moved:
+            self.version += 1
+            self._drive.index(node)
+
+        # The alternate videos of a video that has been replaced need to be
+        # looked up again
+        if node._item is not None and node._item.get("modifiedDate") != item.get("modifiedDate"):
+            self._drive.forget_urls(node.id)
+
+        # Set the attributes for this node
+        node._item   = item
+        node.attribs = item.copy()
+
+        # Update the mtime for all children
+        try:
+            node._update_mtime(get_timestamp(node.attribs.get("modifiedDate")))
+        except:
+            log.error("Couldn't update mtime")
+
+        # If the "videoMediaMetadata" key is present, then this is a video
+        if node.attribs.has_key("videoMediaMetadata") or node.attribs.get("fileExtension") in self._drive.VIDEO_EXTS:
+            # Since this is a video, we need to do a few things:
+            #   (1) Change this node from a video to a directory
+            #   (2) Add this video as a child to the directory node
+            #   (3) Add alternate videos as children to the directory node
+
+            # Turn this video into a directory
+            node.attribs.update({
+                "originalMimeType": item.get("mimeType"),
+                "originalFileSize": item.get("fileSize"),
+                "fileSize":         self.FOLDER_BYTES,
+                "mimeType":         self.FOLDER_MIMETYPE
+            })
+
+        return node
 
     def refresh_url(self):
         """
@@ -343,8 +653,8 @@ class Node:
             # This is not a video
             return
 
-        # Get an updated list of videos
-        videos = self._drive.get_urls_for_docid(self.id)
+        # Get an updated list of videos, as the cached one is evidently stale
+        videos = self._drive.get_urls_for_docid(self.id, force=True)
         if videos and len(videos) > 0:
             # Try to find the video that matches us
             for video in videos:
@@ -360,382 +670,3018 @@ class Node:
                     break
 
         if match:
-            self.video_attribs = match
+            # Keep the size that has already been looked up
+            self.video_attribs["url"] = match["url"]
             return True
 
         return False
 
 
-class Drive(object):
-    PROTOCOL    = 'https://'
-
-    def __init__(self, config):
-        self._config    = config
-        self._storage   = Storage(os.path.expanduser(config.get(CONFIG_SECTION, "oath_storage")))
-        self._creds     = self._storage.get()
-        self._flow      = OAuth2WebServerFlow(config.get(CONFIG_SECTION, "client_id"),
-                                              config.get(CONFIG_SECTION, "client_secret"),
-                                              config.get(CONFIG_SECTION, "oauth_scope"),
-                                              redirect_uri=config.get(CONFIG_SECTION, "redirect_uri"))
-        
-        # Each thread needs to have it's own http and service instance
-        self._http          = {}
-        self._service       = {}
+class PooledResponse(object):
+    """
+    A response to a request made through a ``ConnectionPool``.  When closed,
+    the underlying connection is returned to the pool if it can be reused.
+    """
 
-        self._tree      = Node('root', 'root', None, self)
-        self._tree_lock = threading.RLock()
+    # Unread data, in bytes, that will be read and discarded in order to be
+    # able to reuse the connection
+    DRAIN_BYTES = 65536
 
-        # File and folder data is cache duration, in seconds
-        self.CACHE_TIME = config.getint(CONFIG_SECTION, "cache_duration")
+    def __init__(self, pool, key, conn, response):
+        self.headers    = response.msg
+        self.status     = response.status
 
-    def get_http(self):
-        tid = thread.get_ident()
-        if not self._http.has_key(tid):
-            self._service[tid], self._http[tid] = self.build_service()
-        return self._http[tid]
+        self._pool      = pool
+        self._key       = key
+        self._conn      = conn
+        self._response  = response
 
-    def get_service(self):
-        tid = thread.get_ident()
-        if not self._service.has_key(tid):
-            self._service[tid], self._http[tid] = self.build_service()
-        return self._service[tid]
+    def read(self, amt=None):
+        return self._response.read(amt)
 
+    def close(self):
+        if self._conn is None:
+            return
 
-    def build_service(self, query=False):
-        if self._creds is not None and self._creds.invalid:
-            self._creds = run(self._flow, self._storage)
+        conn, self._conn = self._conn, None
+        response = self._response
 
-        while self._creds is None:
-            print "\nGo to the following URL and copy-paste the code below:\n\n", self._flow.step1_get_authorize_url()
-            try:
-                self._creds = self._flow.step2_exchange(raw_input("\nCode: ").strip())
-                if self._creds:
-                    self._storage.put(self._creds)
-            except FlowExchangeError:
-                print "The code was invalid, please try again"
+        try:
+            if not response.isclosed() and response.length is not None and response.length <= self.DRAIN_BYTES:
+                response.read()
+        except (httplib.HTTPException, socket.error):
+            pass
 
-        # Setup HTTP
-        http = httplib2.Http(timeout=5)
-        self._creds.authorize(http)
+        if response.isclosed() and not response.will_close:
+            self._pool._release(self._key, conn)
+        else:
+            # Unread data is still on the wire, so the connection can't be reused
+            response.close()
+            conn.close()
+            self._pool._release(self._key, None)
 
-        # Setup the service
-        service = build('drive', 'v2', http=http)
+class ConnectionPool(object):
+    """
+    A thread-safe pool of persistent HTTP connections, kept per host.
 
-        return service, http
+    At most ``max_connections`` connections per host are kept alive.  Requests
+    are never blocked waiting for a connection; any connections beyond the
+    limit are closed once they are done with.  Idle connections are closed
+    after ``idle_timeout`` seconds.
+    """
 
-    def list_dir(self, path):
-        segments = full_path_split(path)
-        count    = len(segments)
-        listing  = {}
+    MAX_REDIRECTS = 5
+
+    def __init__(self, max_connections, idle_timeout, timeout=30):
+        self.max_connections    = max_connections
+        self.idle_timeout       = idle_timeout
+        self.timeout            = timeout
+
+        self._idle      = {}
+        self._in_use    = {}
+        self._lock      = threading.Lock()
+        self._stats     = {
+            "requests":     0,
+            "created":      0,
+            "reused":       0,
+            "discarded":    0,
+            "expired":      0,
+            "redirects":    0
+        }
 
-        # Lock
-        self._tree_lock.acquire()
+    def _acquire(self, key):
+        """
+        Returns a ``(connection, reused)`` tuple for the given
+        ``(scheme, host)``.
+        """
+        now = time.time()
 
-        parent = self._tree
-        for i in range(len(segments)):
-            if parent is None:
-                break
+        with self._lock:
+            idle = self._idle.get(key, [])
+            self._in_use[key] = self._in_use.get(key, 0) + 1
 
-            segment  = segments.pop(0)
-            children = parent.get_children()
-            parent   = children.get(segment)
-        
-        if parent:
-            listing = parent.get_children()
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    self._stats["reused"] += 1
+                    return conn, True
 
-        # Lock
-        self._tree_lock.release()
+                self._stats["expired"] += 1
+                conn.close()
 
-        return listing
+            self._stats["created"] += 1
 
-    def get_urls_for_docid(self, docid):
-        params  = urllib.urlencode({'docid': docid})
-        url     = self.PROTOCOL+'docs.google.com/get_video_info?docid='+str(docid)
-        http    = self.get_http()
+        scheme, host = key
+        if scheme == "https":
+            conn = httplib.HTTPSConnection(host, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(host, timeout=self.timeout)
 
-        for i in range(3):
-            try:
-                status, response_data = http.request(url, "GET")
-                self._cookies = status['set-cookie']
-                break
-            except Exception, e:
-                log.error("Error get_urls_for_docid: '%s' ... trying again" % str(e))
-                if i == 2:
-                    log.error("Error get_urls_for_docid: '%s' ... giving up" % str(e))
-                    return []
+        return conn, False
 
-        # Decode resulting player URL (URL is composed of many sub-URLs)
-        urls = response_data
-        urls = urllib.unquote(urllib.unquote(urllib.unquote(urllib.unquote(urllib.unquote(urls)))))
-        urls = re.sub('\\\\u003d', '=', urls)
-        urls = re.sub('\\\\u0026', '&', urls)
+    def _release(self, key, conn):
+        with self._lock:
+            self._in_use[key] -= 1
 
-        # Do some substitutions to make anchoring the URL easier
-        urls = re.sub('\&url\='+self.PROTOCOL, '\@', urls)
+            if conn is None:
+                self._stats["discarded"] += 1
+                return
 
-        itagDB      = {}
-        containerDB = {
-            'x-flv':'flv',
-            'webm': 'WebM',
-            'mp4;+codecs="avc1.42001E,+mp4a.40.2"': 'MP4'}
+            idle = self._idle.setdefault(key, [])
+            if len(idle) + self._in_use[key] >= self.max_connections:
+                self._stats["discarded"] += 1
+                conn.close()
+            else:
+                idle.append((conn, time.time()))
 
-        for r in re.finditer('(\d+)/(\d+)x(\d+)/(\d+/\d+/\d+)\&?\,?', urls, re.DOTALL):
-            (itag,resolution1,resolution2,codec) = r.groups()
+    def request(self, url, headers=None):
+        """
+        Performs a GET request for ``url``, following redirects.  Returns a
+        ``PooledResponse``, or raises ``urllib2.HTTPError`` if the server
+        responds with an error.
+        """
+        headers = dict(headers or {})
+
+        for i in range(self.MAX_REDIRECTS+1):
+            parts   = urlparse.urlsplit(url)
+            key     = (parts.scheme, parts.netloc)
+            path    = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+
+            with self._lock:
+                self._stats["requests"] += 1
+
+            # A reused connection may have been closed by the server, in which
+            # case we try again on a fresh one
+            for attempt in range(2):
+                conn, reused = self._acquire(key)
+                try:
+                    conn.request("GET", path, headers=headers)
+                    response = conn.getresponse()
+                    break
+                except (httplib.HTTPException, socket.error), e:
+                    conn.close()
+                    self._release(key, None)
+                    if not reused or attempt > 0:
+                        raise urllib2.URLError(e)
 
-            itagDB[itag] = {
-                "width":  resolution1,
-                "height": resolution2,
-                "codec":  codec
-            }
+            res = PooledResponse(self, key, conn, response)
 
-            # Rename some codecs
-            if codec == '9/0/115':
-                itagDB[itag]['codec'] = 'h.264/aac'
-            elif codec == '99/0/0':
-                itagDB[itag]['codec'] = 'VP8/vorbis'
+            if res.status in (301, 302, 303, 307) and res.headers.get("location"):
+                url = urlparse.urljoin(url, res.headers.get("location"))
+                res.close()
+                with self._lock:
+                    self._stats["redirects"] += 1
+                continue
 
-        mediaUrls = []
-        count = 0
-        for r in re.finditer('\@([^\@]+)', urls):
-            # XXX: Testing `rstrip("//")`
-            videoURL = self.PROTOCOL+r.group(1).rstrip("//")
-            for q in re.finditer('itag\=(\d+).*?type\=video\/([^\&]+)\&quality\=(\w+)', videoURL, re.DOTALL):
-                (itag,container,quality) = q.groups()
+            if res.status >= 400:
+                res.close()
+                raise urllib2.HTTPError(url, res.status, response.reason, res.headers, None)
 
-                if containerDB[container].lower() not in self._config.get(CONFIG_SECTION, "include_formats").lower():
-                    continue
+            return res
 
-                count = count + 1
+        raise urllib2.URLError("Too many redirects: %s" % url)
 
-                mediaUrls.append({
-                    "quality":    quality,
-                    "width":      itagDB[itag]['width'],
-                    "height":     itagDB[itag]['height'],
-                    "codec":      itagDB[itag]['codec'],
-                    "container":  container,
-                    "extension":  containerDB[container].lower(),
-                    "url":        videoURL
-                })
-        return mediaUrls
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["idle"]   = sum([len(c) for c in self._idle.values()])
+            stats["in_use"] = sum(self._in_use.values())
+            return stats
 
-class GDVFS(fuse.Operations):
-    def __init__(self, drive):
-        self.drive  = drive
+class Timer(object):
+    """
+    Records the time spent in a ``with`` block in a histogram of ``Metrics``.
+    """
 
-        # TODO: This should be a map from a path to another dict of file handles
-        #       rather than just to a single handle.  That way, we can better support
-        #       having the same file opened via multiple handles.
-        self.opened = {}
+    def __init__(self, metrics, name):
+        self.metrics    = metrics
+        self.name       = name
 
-    # Disable unused operations
-    flush       = None
-    open        = None
-    opendir     = None
-    releasedir  = None
-    statfs      = None
-    chmod       = None
-    chown       = None
-    access      = None
+    def __enter__(self):
+        self.start = time.time()
+        return self
 
-    def _remove_handle(self, path):
-        if self.opened.has_key(path):
-            self.opened[path].close()
-            self.opened.pop(path, None)
+    def __exit__(self, type, value, traceback):
+        self.metrics.observe(self.name, time.time()-self.start)
+        if type is not None:
+            self.metrics.incr(self.name + ".errors")
 
-    def listxattr(self, path):
-        return ["user.url", "user.cookie"]
+class Metrics(object):
+    """
+    Counters and latency histograms, plus gauges that are read from other
+    objects when a snapshot is taken.  Snapshots can be rendered as JSON or in
+    the Prometheus text format.
+    """
 
-    def getxattr(self, path, name):
-        head, tail  = os.path.split(path)
-        folder      = self.drive.list_dir(head)
+    # Upper bounds, in seconds, of the histogram buckets
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+
+    def __init__(self):
+        self.started    = time.time()
+
+        self._counters  = {}
+        self._hists     = {}
+        self._gauges    = {}
+        self._lock      = threading.Lock()
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        with self._lock:
+            hist = self._hists.get(name)
+            if hist is None:
+                hist = self._hists[name] = {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0]*len(self.BUCKETS)}
+
+            hist["count"] += 1
+            hist["sum"]   += seconds
+            hist["max"]    = max(hist["max"], seconds)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    hist["buckets"][i] += 1
+                    break
 
-        if folder and folder.has_key(tail):
-            node = folder[tail]
-            if name == "user.url":
-                for i in range(3):
-                    try:
-                        return node.get_video_url()
-                    except:
-                        node.refresh_url()
-            elif name == "user.cookie":
-                return getattr(self.drive, '_cookies', '')
-        return ""
+    def timer(self, name):
+        return Timer(self, name)
 
-    def read(self, path, length, offset, fh):
-        log.debug("read: %s:%d -> %d +%d" % (path, fh, offset, length))
+    def gauge(self, name, func):
+        """
+        Registers ``func``, which returns a number or a dict of numbers, to be
+        read as ``name`` in each snapshot.
+        """
+        self._gauges[name] = func
+
+    def _percentile(self, hist, p):
+        # The upper bound of the bucket the percentile falls in
+        rank  = hist["count"]*p/100.0
+        total = 0
+        for i, count in enumerate(hist["buckets"]):
+            total += count
+            if total >= rank:
+                return min(self.BUCKETS[i], hist["max"])
+        return hist["max"]
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            hists    = {}
+            for name, hist in self._hists.items():
+                hists[name] = {
+                    "count":    hist["count"],
+                    "sum":      hist["sum"],
+                    "max":      hist["max"],
+                    "p50":      self._percentile(hist, 50),
+                    "p90":      self._percentile(hist, 90),
+                    "p99":      self._percentile(hist, 99),
+                    "buckets":  list(hist["buckets"])
+                }
+
+        gauges = {}
+        for name, func in self._gauges.items():
+            try:
+                gauges[name] = func()
+            except Exception, e:
+                log.error("Error reading gauge %s: %s" % (name, str(e)))
 
-        fh   = None
-        data = ""
+        return {
+            "uptime":       time.time()-self.started,
+            "counters":     counters,
+            "gauges":       gauges,
+            "histograms":   hists
+        }
 
-        # Check to see if the requested path has been previously opened
-        if path in self.opened:
-            if self.opened[path]._pos == offset:
-                # Use previously opened handle
-                fh = self.opened[path]
+    def to_json(self):
+        snapshot = self.snapshot()
+        for hist in snapshot["histograms"].values():
+            # JSON has no infinity, so buckets are given by their upper bounds
+            hist["buckets"] = dict([(str(b), c) for b, c in zip(self.BUCKETS[:-1], hist["buckets"]) if c] +
+                                   [("inf", hist["buckets"][-1])])
+        return json.dumps(snapshot, indent=2, sort_keys=True)
+
+    def _prometheus_name(self, name):
+        return "gdvfs_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines    = []
+
+        for name, value in sorted(snapshot["counters"].items()):
+            name = self._prometheus_name(name) + "_total"
+            lines += ["# TYPE %s counter" % name, "%s %s" % (name, value)]
+
+        gauges = []
+        for name, value in snapshot["gauges"].items():
+            if isinstance(value, dict):
+                gauges.extend([("%s.%s" % (name, k), v) for k, v in value.items()])
             else:
-                # Since the requested position does not match the current position,
-                # a SEEK is required.  However, since we can't seek on the open
-                # handle, we must first close it and then open a new one at the desired
-                # offset using the "Range" header (see below)
-                log.debug("Seek required, closing handle: %s" % path)
-                self._remove_handle(path)
+                gauges.append((name, value))
+        for name, value in sorted(gauges):
+            if isinstance(value, (int, long, float)):
+                name = self._prometheus_name(name)
+                lines += ["# TYPE %s gauge" % name, "%s %s" % (name, value)]
+
+        lines += ["# TYPE gdvfs_uptime_seconds gauge", "gdvfs_uptime_seconds %s" % snapshot["uptime"]]
+
+        for name, hist in sorted(snapshot["histograms"].items()):
+            name  = self._prometheus_name(name) + "_seconds"
+            total = 0
+            lines.append("# TYPE %s histogram" % name)
+            for bound, count in zip(self.BUCKETS, hist["buckets"]):
+                total += count
+                lines.append('%s_bucket{le="%s"} %d' % (name, "+Inf" if bound == float("inf") else bound, total))
+            lines += ["%s_sum %s" % (name, hist["sum"]), "%s_count %d" % (name, hist["count"])]
+
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        """
+        Writes the metrics to ``path`` in the Prometheus text format, replacing
+        the previous file in one step so that readers never see a partial file.
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.to_prometheus())
+        os.rename(tmp_path, path)
 
-        # If we don't have an opened file, let's try to open one
-        if fh is None:
-            head, tail  = os.path.split(path)
-            folder      = self.drive.list_dir(head)
+class TimedLock(object):
+    """
+    A lock that records the time threads spend waiting for it in a histogram of
+    ``metrics``, named "lock.<name>".  Acquisitions that don't have to wait
+    aren't timed.
+    """
 
-            if folder and folder.has_key(tail):
-                log.debug("Opening: %s" % path)
+    # Threads currently waiting for a lock, as ``{thread id: (lock name, since)}``
+    waiting = {}
 
-                node = folder[tail]
+    def __init__(self, name, metrics):
+        self.name       = "lock." + name
+        self.metrics    = metrics
 
-                #   a) try again, or
-                #   b) check to see if a new URL needs to be generated
-                for i in range(2):
-                    try:
-                        url = node.get_video_url()
-                        hdrs = {
-                            'Authorization': 'Bearer %s' % self.drive._creds.access_token,
-                            'Cookie':         self.drive._cookies,
-                            'Range':         'bytes=%d-' % (offset)}
-                        req  = urllib2.Request(url, None, hdrs)
-                        fh   = urllib2.urlopen(req)
-                        break
-                    except urllib2.HTTPError, e:
-                        if e.code == 403:
-                            # Looks like this URL is stale, we need to get a new one
-                            log.info("Video URL has expired...trying to get new one")
+        self._lock      = threading.Lock()
 
-                            node.refresh_url()
+    def acquire(self, blocking=True):
+        if self._lock.acquire(False):
+            return True
+        if not blocking:
+            return False
 
-                            # Try again
-                            continue
-                    except Exception, e:
-                        log.error("Error opening url: %s" % str(e))
+        tid   = thread.get_ident()
+        start = time.time()
+        self.waiting[tid] = (self.name, start)
+        try:
+            self._lock.acquire()
+        finally:
+            self.waiting.pop(tid, None)
+        self.metrics.observe(self.name, time.time()-start)
+        return True
 
-                    # Give up
-                    raise fuse.FuseOSError(errno.EIO)
-                
-                # Cache the opened URL and set the offset
-                fh._pos             = offset
-                self.opened[path]   = fh
-            else:
-                # Emulate "I/O error"
-                raise fuse.FuseOSError(errno.EIO)
+    def release(self):
+        self._lock.release()
 
-        try:
-            # Get the data
-            data = fh.read(length)
-            amt  = len(data)
+    def __enter__(self):
+        self.acquire()
 
-            log.debug("Read %d bytes" % amt)
+    def __exit__(self, type, value, traceback):
+        self.release()
 
-            # Keep track of position in opened handle
-            self.opened[path]._pos += amt
-        except Exception, e:
-            log.error("Read error: %s" % str(e))
+def format_stacks():
+    """
+    Returns the current stack of every thread, noting the locks that threads
+    are waiting for.
+    """
+    names = dict([(t.ident, t.name) for t in threading.enumerate()])
+    now   = time.time()
+    lines = ["Threads at %s" % time.strftime("%Y-%m-%d %H:%M:%S"), ""]
 
-            # TODO: Handle this read error better...
-            self._remove_handle(path)
+    for tid, frame in sorted(sys._current_frames().items()):
+        lines.append("Thread %s (%d)" % (names.get(tid, "unknown"), tid))
+        waiting = TimedLock.waiting.get(tid)
+        if waiting:
+            lines.append("  waiting for %s for %.3f seconds" % (waiting[0], now-waiting[1]))
+        lines.extend(["  " + l.rstrip() for l in traceback.format_stack(frame)])
+        lines.append("")
 
-            # Emulate "I/O error"
-            raise fuse.FuseOSError(errno.EIO)
+    return "\n".join(lines)
 
-        return data
+class Profiler(object):
+    """
+    A sampling profiler of all threads.  Once started, the stack of every thread
+    is sampled every ``interval`` seconds for ``duration`` seconds, and a report
+    of the functions seen most often is made.  Nothing is done until a profile
+    is started.
+    """
 
-    def release(self, path, fh):
-        log.debug("release: %s:%d" % (path, fh))
-        if path in self.opened:
-            self._remove_handle(path)
+    def __init__(self, metrics, duration, interval, path=None):
+        self.metrics    = metrics
+        self.duration   = duration
+        self.interval   = interval
+        self.path       = path
+        self.report     = None
+        self.running    = False
 
-    def readdir(self, path, fh):
-        log.debug("readdir: %s" % path)
-        return ['.', '..'] + self.drive.list_dir(path).keys()
+        self._lock      = threading.Lock()
 
-    def getattr(self, path, fh=None):
-        log.debug("getattr: %s" % path)
-        
-        head, tail  = os.path.split(path)
-        folder      = self.drive.list_dir(head)
-
-        if folder and folder.has_key(tail):
-            # Regular file or folder
-            return folder[tail].lstat()
-        elif head == "/" and tail == "":
-            # Root directory
-            return self.drive._tree.lstat()
-        
-        log.debug("Unknown path: %s" % path)
-        raise fuse.FuseOSError(errno.ENOENT)
+    def start(self):
+        """
+        Starts a profile in the background, unless one is already running.
+        """
+        with self._lock:
+            if self.running:
+                return False
+            self.running = True
+
+        log.info("Profiling for %d seconds" % self.duration)
+        t = threading.Thread(target=self._run, name="profiler")
+        t.daemon = True
+        t.start()
+        return True
+
+    def get_report(self):
+        if self.report is None:
+            return "Profiling for %d seconds, read again for the report\n" % self.duration
+        if self.running:
+            return "Profiling for %d seconds, the previous report follows\n\n%s" % (self.duration, self.report)
+        return self.report
+
+    def _run(self):
+        try:
+            own, total, stacks, samples = self.sample()
+            report = self.format(own, total, stacks, samples)
+            self.report = report
+
+            if self.path:
+                name = os.path.join(self.path, time.strftime("profile-%Y%m%d-%H%M%S"))
+                with open(name + ".txt", "w") as f:
+                    f.write(report)
+                with open(name + ".folded", "w") as f:
+                    # Collapsed stacks, as used by flame graph tools
+                    for stack, count in sorted(stacks.items()):
+                        f.write("%s %d\n" % (";".join(stack), count))
+                log.info("Wrote profile to: %s.txt" % name)
+        except Exception, e:
+            log.error("Error profiling: %s" % str(e))
+        finally:
+            with self._lock:
+                self.running = False
 
-def setup_logging(config, foreground):
-    stream_handler = logging.StreamHandler(sys.stdout)
-    stream_handler.setFormatter(logging.Formatter())
+    def sample(self):
+        """
+        Returns the number of samples each function was running in (``own``)
+        and was on the stack in (``total``), and the number of samples of each
+        stack.
+        """
+        me      = thread.get_ident()
+        own     = collections.defaultdict(int)
+        total   = collections.defaultdict(int)
+        stacks  = collections.defaultdict(int)
+        samples = 0
+        end     = time.time() + self.duration
+
+        while time.time() < end:
+            names = dict([(t.ident, t.name) for t in threading.enumerate()])
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
 
-    debug = config.getboolean(CONFIG_SECTION, "debug")
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s:%d(%s)" % (os.path.basename(code.co_filename), code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
 
-    log.setLevel(logging.DEBUG)
+                own[stack[0]] += 1
+                for func in set(stack):
+                    total[func] += 1
 
-    if debug or foreground:
-        stream_handler.setLevel(logging.DEBUG)
-    else:
-        stream_handler.setLevel(logging.INFO)
+                # Threads in a pool share a name, apart from their number
+                stack.append(re.sub(r"-\d+$", "", names.get(tid, "unknown")))
+                stack.reverse()
+                stacks[tuple(stack)] += 1
 
-    log.addHandler(stream_handler)
+            samples += 1
+            time.sleep(self.interval)
 
-    if config.has_option(CONFIG_SECTION, "log_path"):
-        file_handler = logging.FileHandler(config.get(CONFIG_SECTION, "log_path"))
-        file_handler.setLevel(logging.DEBUG)
-        file_handler.setFormatter(logging.Formatter("[%(levelname)-8s] [%(name)s] %(msg)s"))
-        log.addHandler(file_handler)
+        return own, total, stacks, samples
 
+    def format(self, own, total, stacks, samples):
+        lines = ["Profile of %d seconds, %d samples every %.1f ms, at %s" % (
+                    self.duration, samples, self.interval*1000, time.strftime("%Y-%m-%d %H:%M:%S")), ""]
 
-def usage():
-    print "Usage:\n"
-    print "  %s [options]" % os.path.basename(sys.argv[0])
-    print "\nOptions:\n"
-    print "  -a (--auth)        : Perform OAuth authentication with Google"
-    print "  -f (--foreground)  : Run in the foreground (don't daemonize)"
-    print "  -c (--config=)     : Path to config file (Default: ~/.gdvfs)"
-    print "  -h (--help)        : Print out this help information"
-    print "\n"
+        for title, counts in (("Running", own), ("On the stack", total)):
+            lines += ["%s (samples, function):" % title, ""]
+            for func, count in sorted(counts.items(), key=lambda i: -i[1])[:30]:
+                lines.append("  %8d  %s" % (count, func))
+            lines.append("")
 
-def main():
-    print "gdvfs version %s, Copyright (C) %s\n" % (__version__, __author__)
+        lines += ["Most common stacks (samples, thread;stack):", ""]
+        for stack, count in sorted(stacks.items(), key=lambda i: -i[1])[:20]:
+            lines.append("  %8d  %s" % (count, ";".join(stack)))
+        lines.append("")
 
-    try:
-        opts, args = getopt.getopt(sys.argv[1:], "afhc:", ["foreground", "help", "config="])
-    except getopt.GetoptError as err:
-        # print help information and exit:
-        print str(err) # will print something like "option -a not recognized"
-        usage()
-        sys.exit(2)
+        # The time spent waiting for locks, since the file system was mounted
+        hists = self.metrics.snapshot()["histograms"]
+        lines += ["Lock waits (count, total s, max s, lock):", ""]
+        for name, hist in sorted(hists.items()):
+            if name.startswith("lock."):
+                lines.append("  %8d  %9.3f  %9.3f  %s" % (hist["count"], hist["sum"], hist["max"], name[5:]))
+        lines.append("")
 
-    config_paths = ["./gdvfs.conf", "~/.gdvfs.conf"]
-    foreground   = False
-    do_auth      = False
+        return "\n".join(lines)
 
-    for o, a in opts:
-        if o in ("-h", "--help"):
-            usage()
-            sys.exit()
-        elif o in ("-c", "--config"):
-            config_paths.insert(0, a)
-        elif o in ("-f", "--foreground"):
-            foreground = True
-        elif o in ("-a", "--auth"):
-            do_auth = True
+class ControlFile(object):
+    """
+    An open handle of a virtual file under ``GDVFS.CONTROL_DIR``, whose
+    contents are rendered once when it is opened.
+    """
 
-    config          = ConfigParser.SafeConfigParser(CONFIG_DEFAULT)
-    config_paths    = [os.path.expanduser(pth) for pth in config_paths]
-    loaded_configs  = config.read(config_paths)
+    node = None
 
-    setup_logging(config, foreground)
+    def __init__(self, data):
+        self.data = data
 
-    log.debug("Loaded config from: %s" % str(loaded_configs))
+    def read(self, length, offset):
+        return self.data[offset:offset+length]
 
-    drive = Drive(config)
+    def close(self):
+        pass
+
+class Task(object):
+    """
+    A function submitted to a ``WorkerPool``, which can be waited on.
+    """
+
+    def __init__(self, func, args):
+        self.func       = func
+        self.args       = args
+        self.result     = None
+        self.error      = None
+        self.submitted  = time.time()
+
+        self._done      = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception, e:
+            self.error = e
+            raise
+        finally:
+            self._done.set()
+
+    def wait(self, timeout=None):
+        """
+        Waits for the task to finish, and returns its result.
+        """
+        self._done.wait(timeout)
+        return self.result
+
+class WorkerPool(object):
+    """
+    A fixed number of daemon threads that run tasks from a shared queue.  The
+    threads are only started once the first task is submitted, so that a pool
+    can be created before the process daemonizes.
+
+    The pool keeps track of how many tasks are queued, and how long they wait
+    in the queue and take to run.
+    """
+
+    def __init__(self, name, threads):
+        self.name       = name
+        self.threads    = threads
+
+        self._queue     = Queue.Queue()
+        self._started   = False
+        self._lock      = threading.Lock()
+        self._stats     = {
+            "submitted":    0,
+            "completed":    0,
+            "failed":       0,
+            "wait_total":   0.0,
+            "wait_max":     0.0,
+            "run_total":    0.0,
+            "run_max":      0.0
+        }
+
+    def _start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+
+            for i in range(self.threads):
+                t = threading.Thread(target=self._run, name="%s-%d" % (self.name, i))
+                t.daemon = True
+                t.start()
+
+    def _run(self):
+        while True:
+            task    = self._queue.get()
+            start   = time.time()
+            failed  = False
+            try:
+                task.run()
+            except Exception, e:
+                log.error("Error in %s worker: %s" % (self.name, str(e)))
+                failed = True
+
+            end = time.time()
+            with self._lock:
+                self._stats["failed" if failed else "completed"] += 1
+                self._stats["wait_total"]  += start - task.submitted
+                self._stats["wait_max"]     = max(self._stats["wait_max"], start - task.submitted)
+                self._stats["run_total"]   += end - start
+                self._stats["run_max"]      = max(self._stats["run_max"], end - start)
+
+    def submit(self, func, *args):
+        if not self._started:
+            self._start()
+
+        task = Task(func, args)
+        with self._lock:
+            self._stats["submitted"] += 1
+        self._queue.put(task)
+        return task
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["threads"] = self.threads
+        stats["queued"]  = self._queue.qsize()
+        return stats
+
+class ChangeSync(object):
+    """
+    Keeps the folder tree up to date by polling the Drive changes feed, and
+    applying inserts, renames, moves and trashes directly to the loaded nodes.
+
+    The page token of the feed is saved to ``state_path``, so that changes
+    made while unmounted are picked up on the next mount.
+    """
+
+    FIELDS = ("items(fileId,deleted,file(id,mimeType,title,createdDate,modifiedDate,fileSize,"
+              "videoMediaMetadata,downloadUrl,fileExtension,labels(trashed),parents(id,isRoot))),"
+              "nextPageToken,newStartPageToken")
+
+    # Number of polls in a row that may fail before folders expire as usual
+    MAX_FAILED_POLLS = 3
+
+    def __init__(self, drive, state_path, interval):
+        self.drive      = drive
+        self.state_path = state_path
+        self.interval   = interval
+        self.token      = None
+
+        # Folders listed before this time may have missed changes made before
+        # the feed was started
+        self.since      = 0
+
+        # Time of the last successful poll
+        self.polled     = 0
+
+        self._lock      = threading.Lock()
+
+    def _load_token(self):
+        try:
+            with open(self.state_path) as f:
+                return f.read().strip() or None
+        except IOError:
+            return None
+
+    def _save_token(self, token):
+        try:
+            with open(self.state_path+".tmp", "w") as f:
+                f.write(token)
+            os.rename(self.state_path+".tmp", self.state_path)
+        except (IOError, OSError), e:
+            log.error("Error saving changes token: %s" % str(e))
+
+    def _fetch_start_token(self):
+        return self.drive.get_service().changes().getStartPageToken().execute()["startPageToken"]
+
+    def _fetch_changes(self, token):
+        with self.drive.metrics.timer("api.changes_list"):
+            return self.drive.get_service().changes().list(pageToken=token,
+                                                           includeDeleted=True,
+                                                           maxResults=1000,
+                                                           fields=self.FIELDS).execute()
+
+    def is_synced(self, updated):
+        """
+        Returns ``True`` if a folder listed at time ``updated`` is being kept up
+        to date by the changes feed, i.e. the feed has been started since and
+        is being polled successfully.
+        """
+        return self.token is not None and updated >= self.since and \
+            time.time()-self.polled < (self.MAX_FAILED_POLLS+1)*self.interval
+
+    def _start_feed(self):
+        since = time.time()
+        token = self._fetch_start_token()
+        self._save_token(token)
+
+        with self._lock:
+            self.since  = since
+            self.polled = since
+            self.token  = token
+
+    def start(self):
+        self.token = self._load_token()
+        if self.token is not None:
+            # Catch up with changes made while unmounted, before anything is
+            # loaded from the metadata store
+            try:
+                self.poll()
+            except Exception, e:
+                log.error("Error polling changes: %s" % str(e))
+
+        if self.token is None:
+            # Only changes made from now on are of interest.  Until the feed
+            # has been started, folders expire as usual.
+            try:
+                self._start_feed()
+            except Exception, e:
+                log.error("Error starting changes feed: %s" % str(e))
+
+        t = threading.Thread(target=self._run, name="changes")
+        t.daemon = True
+        t.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                if self.token is None:
+                    self._start_feed()
+                else:
+                    self.poll()
+            except Exception, e:
+                log.error("Error polling changes: %s" % str(e))
+
+    def poll(self):
+        """
+        Fetches and applies all changes since the last poll.  Returns the
+        number of changes applied.
+        """
+        count = 0
+        start = time.time()
+
+        with self._lock:
+            token = self.token
+            while token:
+                try:
+                    result = self._fetch_changes(token)
+                except errors.HttpError, e:
+                    if e.resp.status in (400, 404):
+                        # The token is no longer valid, so the feed has to be
+                        # started again, and folders listed again
+                        log.error("Changes token was rejected: %s" % token)
+                        self.token  = None
+                        self.since  = 0
+                    raise
+
+                for change in result.get("items", []):
+                    self.apply(change)
+                    count += 1
+
+                if result.get("newStartPageToken"):
+                    self.token = result["newStartPageToken"]
+                    self._save_token(self.token)
+
+                token = result.get("nextPageToken")
+
+            if self.token is not None:
+                self.polled = start
+
+        if count:
+            log.info("Applied %d changes" % count)
+        return count
+
+    def apply(self, change):
+        file_id = change["fileId"]
+        item    = change.get("file")
+        removed = change.get("deleted") or not item or item.get("labels", {}).get("trashed")
+
+        parent_ids = set()
+        if not removed:
+            for parent in item.get("parents", []):
+                parent_ids.add("root" if parent.get("isRoot") else parent["id"])
+
+        store = self.drive._store
+        if store:
+            # Folders that haven't been loaded yet need to be reconciled when
+            # they are loaded from the store
+            store.expire(*(parent_ids | store.get_parent_ids(file_id)))
+
+        # Detach the existing nodes for this file that have been removed, moved
+        # or renamed
+        existing = [n for n in self.drive.find_nodes(file_id) if n.video_attribs is None and
+                    n.parent is not None and n.parent.id != file_id]
+        detached = []
+        for node in existing:
+            parent = node.parent
+            with parent._lock:
+                if parent.children.get(node.title) is not node:
+                    # Already removed by a refresh of the folder
+                    continue
+
+                # Other children with the old title may need to be shown
+                # differently once this one is removed or renamed
+                old_title = (node._item or node.attribs).get("title")
+
+                if removed or parent.id not in parent_ids:
+                    log.info("Removing child: %s" % node.title)
+                    parent._remove_child(node.title)
+                    parent._retitle(old_title)
+                    detached.append(node)
+                    self._save(parent)
+                else:
+                    parent_ids.discard(parent.id)
+                    self._set_child(parent, item, node)
+                    if old_title != item["title"]:
+                        parent._retitle(old_title)
+                        self._save(parent)
+
+        if removed:
+            return
+
+        # Add the file to the folders it now appears in, that have been loaded
+        for parent in self.drive.find_nodes(*parent_ids):
+            with parent._lock:
+                if parent.updated and parent.video_attribs is None and not parent.attribs.has_key("originalMimeType"):
+                    log.info("Adding child: %s" % item["title"])
+                    self._set_child(parent, item, detached.pop() if detached else None)
+
+    def _set_child(self, parent, item, node):
+        """
+        Must be called with ``parent._lock`` held.
+        """
+        # Files with the same title are shown as they would be if the folder
+        # was listed again
+        title = parent._retitle(item["title"], item)
+        if node is not None and parent.children.get(node.title) is node and node.title != title:
+            log.info("Renaming child: %s -> %s" % (node.title, title))
+            parent._remove_child(node.title)
+
+        node = parent._set_child(item, node, title)
+        if node.attribs.has_key("originalMimeType"):
+            # The alternate videos of a video need to be looked up again,
+            # rather than loaded from the store as they were before the change
+            node.updated = 0
+            if self.drive._store:
+                self.drive._store.delete(node.id)
+        self._save(parent)
+
+    def _save(self, node):
+        if self.drive._store:
+            self.drive._store.save(node)
+
+class MetadataStore(object):
+    """
+    Persists the folder tree, including alternate videos and their sizes, in a
+    SQLite database so that it can be browsed straight away after a remount.
+    Each loaded node has a row in ``folders`` and a row in ``nodes`` for each
+    of its children.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS folders (
+            id              TEXT PRIMARY KEY,
+            updated         REAL
+        );
+        CREATE TABLE IF NOT EXISTS nodes (
+            parent_id       TEXT,
+            title           TEXT,
+            id              TEXT,
+            attribs         TEXT,
+            video_attribs   TEXT,
+            PRIMARY KEY (parent_id, title)
+        );
+        CREATE INDEX IF NOT EXISTS nodes_id ON nodes (id);
+    """
+
+    def __init__(self, path):
+        self.path   = path
+        self._db    = sqlite3.connect(path, check_same_thread=False)
+        self._lock  = threading.Lock()
+
+        with self._lock:
+            self._db.executescript(self.SCHEMA)
+
+    def load(self, id):
+        """
+        Returns an ``(updated, children)`` tuple for the node with the given id,
+        or ``None`` if it isn't stored.  ``updated`` is ``0`` if the node has
+        since been expired.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT updated FROM folders WHERE id = ?", (id,)).fetchone()
+            if row is None:
+                return None
+
+            children = []
+            for id, title, attribs, video_attribs in self._db.execute(
+                    "SELECT id, title, attribs, video_attribs FROM nodes WHERE parent_id = ?", (id,)):
+                children.append((id, title, json.loads(attribs), json.loads(video_attribs) if video_attribs else None))
+
+        return row[0], children
+
+    def save(self, node):
+        rows = []
+        for child in node.children.values():
+            rows.append((node.id, child.title, child.id, json.dumps(child.attribs),
+                         json.dumps(child.video_attribs) if child.video_attribs else None))
+
+        with self._lock:
+            with self._db:
+                self._db.execute("DELETE FROM nodes WHERE parent_id = ?", (node.id,))
+                self._db.executemany("INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?, ?)", rows)
+                self._db.execute("INSERT OR REPLACE INTO folders VALUES (?, ?)", (node.id, node.updated))
+
+    def save_video_attribs(self, node):
+        with self._lock:
+            with self._db:
+                self._db.execute("UPDATE nodes SET video_attribs = ? WHERE parent_id = ? AND title = ?",
+                                 (json.dumps(node.video_attribs), node.parent.id, node.title))
+
+    def get_parent_ids(self, id):
+        with self._lock:
+            return set([r[0] for r in self._db.execute("SELECT parent_id FROM nodes WHERE id = ?", (id,))])
+
+    def delete(self, id):
+        """
+        Forgets the children stored for the node with the given id.
+        """
+        with self._lock:
+            with self._db:
+                self._db.execute("DELETE FROM folders WHERE id = ?", (id,))
+                self._db.execute("DELETE FROM nodes WHERE parent_id = ?", (id,))
+
+    def expire(self, *ids):
+        with self._lock:
+            with self._db:
+                self._db.executemany("UPDATE folders SET updated = 0 WHERE id = ?", [(i,) for i in ids])
+
+class TokenManager(object):
+    """
+    Hands out the OAuth access token of ``drive``, refreshing it shortly before
+    it expires.  Only one thread refreshes the token at a time, and threads that
+    need it meanwhile wait for that refresh rather than doing their own.
+    """
+
+    def __init__(self, drive, margin):
+        self.drive      = drive
+        self.margin     = margin
+
+        # Held while refreshing
+        self._lock      = threading.Lock()
+
+    def _seconds_left(self):
+        """
+        Returns the number of seconds until the token expires, or ``None`` if it
+        isn't known when it expires.
+        """
+        expiry = getattr(self.drive._creds, "token_expiry", None)
+        if expiry is None:
+            return None
+        delta = expiry - datetime.datetime.utcnow()
+        return delta.days*86400 + delta.seconds
+
+    def _needs_refresh(self):
+        if not self.drive._creds.access_token:
+            return True
+        left = self._seconds_left()
+        return left is not None and left < self.margin
+
+    def get_token(self):
+        if self._needs_refresh():
+            with self._lock:
+                # Another thread may have refreshed it while we waited
+                if self._needs_refresh():
+                    self._refresh()
+        return self.drive._creds.access_token
+
+    def refresh(self, rejected):
+        """
+        Refreshes the token after ``rejected`` was refused, unless another
+        thread has already replaced it.  Returns the new token.
+        """
+        with self._lock:
+            if self.drive._creds.access_token == rejected:
+                self._refresh()
+        return self.drive._creds.access_token
+
+    def _refresh(self):
+        # Must be called with ``_lock`` held
+        log.info("Refreshing access token")
+        self.drive.metrics.incr("token_refreshes")
+        with self.drive.metrics.timer("api.token_refresh"):
+            self.drive._creds.refresh(httplib2.Http(timeout=10))
+
+    def authorize(self, http):
+        """
+        Makes ``http`` send a valid token with each request, and retry once with
+        a new token if the token is refused.
+        """
+        request = http.request
+
+        def authorized_request(uri, method="GET", body=None, headers=None, *args, **kwargs):
+            headers = dict(headers or {})
+            for i in range(2):
+                token = self.get_token()
+                headers["Authorization"] = "Bearer %s" % token
+                response, content = request(uri, method, body, headers, *args, **kwargs)
+                if response.status != 401 or i:
+                    return response, content
+
+                log.info("Access token was refused")
+                self.drive.metrics.incr("token_refused")
+                self.refresh(token)
+
+        http.request = authorized_request
+        return http
+
+    def start(self):
+        t = threading.Thread(target=self._run, name="token")
+        t.daemon = True
+        t.start()
+
+    def _run(self):
+        # Refresh the token before it expires, so that requests don't have to
+        # wait for it
+        while True:
+            left = self._seconds_left() if self.drive._creds else None
+            if left is None:
+                time.sleep(60)
+            else:
+                time.sleep(min(max(left-self.margin, 1), 300))
+
+            try:
+                if self.drive._creds:
+                    self.get_token()
+            except Exception, e:
+                log.error("Error refreshing access token: %s" % str(e))
+
+class ClientPool(object):
+    """
+    Gives each thread its own Drive API client, as a ``(service, http)`` pair
+    made by ``factory``, since neither is thread-safe.  Clients that their
+    thread hasn't used for ``idle_timeout`` seconds, e.g. because the thread
+    has exited, are taken back and handed to new threads.  At most ``max_idle``
+    clients are kept for reuse.
+    """
+
+    def __init__(self, factory, max_idle, idle_timeout):
+        self.factory        = factory
+        self.max_idle       = max_idle
+        self.idle_timeout   = idle_timeout
+
+        self._clients       = {}
+        self._idle          = []
+        self._last_reaped   = time.time()
+        self._stats         = {"built": 0, "reused": 0, "reaped": 0}
+        self._lock          = threading.Lock()
+
+    def get(self):
+        tid = thread.get_ident()
+        now = time.time()
+        if now-self._last_reaped > self.idle_timeout/2.0:
+            with self._lock:
+                self._reap(now)
+
+        entry = self._clients.get(tid)
+        if entry is not None:
+            entry[1] = now
+            return entry[0]
+
+        # This thread hasn't had a client yet, or its client was taken back
+        with self._lock:
+            client = self._idle.pop() if self._idle else None
+            if client is not None:
+                self._stats["reused"] += 1
+
+        if client is None:
+            client = self.factory()
+            with self._lock:
+                self._stats["built"] += 1
+
+        with self._lock:
+            self._clients[tid] = [client, now]
+        return client
+
+    def _reap(self, now):
+        # Must be called with ``_lock`` held
+        self._last_reaped = now
+        for tid, (client, used) in self._clients.items():
+            if now-used > self.idle_timeout:
+                del self._clients[tid]
+                self._stats["reaped"] += 1
+                if len(self._idle) < self.max_idle:
+                    self._idle.append(client)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["threads"] = len(self._clients)
+            stats["idle"]    = len(self._idle)
+            return stats
+
+class VideoInfoParser(object):
+    """
+    Parses ``get_video_info`` responses into a list of alternate videos.  The
+    response is a query string, in which ``fmt_list`` gives the size and codecs
+    of each format (e.g. "22/1280x720/9/0/115") and ``url_encoded_fmt_stream_map``
+    holds a comma separated query string per format with its URL and type.
+    """
+
+    FMT_RE      = re.compile(r'(\d+)/(\d+)x(\d+)/(\d+/\d+/\d+)')
+
+    # Containers by the subtype of each format's mimetype
+    CONTAINERS  = {
+        'x-flv':    'flv',
+        'webm':     'webm',
+        'mp4':      'mp4'
+    }
+
+    # Friendlier names for some codecs
+    CODECS      = {
+        '9/0/115':  'h.264/aac',
+        '99/0/0':   'VP8/vorbis'
+    }
+
+    INFO_FIELDS     = frozenset(["fmt_list", "url_encoded_fmt_stream_map"])
+    STREAM_FIELDS   = frozenset(["itag", "url", "type", "quality"])
+
+    def __init__(self, include_formats):
+        self.include_formats = set([f.strip().lower() for f in include_formats.split(",")])
+
+    def _fields(self, query, names):
+        """
+        Returns the decoded values of ``names`` in the query string ``query``.
+        Other fields are skipped without being decoded.
+        """
+        fields = {}
+        for field in query.split("&"):
+            name, _, value = field.partition("=")
+            if name in names:
+                fields[name] = urllib.unquote_plus(value)
+        return fields
+
+    def parse(self, data):
+        info = self._fields(data, self.INFO_FIELDS)
+
+        formats = {}
+        for fmt in info.get("fmt_list", "").split(","):
+            match = self.FMT_RE.match(fmt)
+            if match:
+                itag, width, height, codec = match.groups()
+                formats[itag] = (width, height, self.CODECS.get(codec, codec))
+
+        stream_map = info.get("url_encoded_fmt_stream_map", "")
+        if "\\u00" in stream_map:
+            # Some responses escape the separators within each format
+            stream_map = stream_map.replace("\\u0026", "&").replace("\\u003d", "=")
+
+        videos = []
+        for stream in stream_map.split(","):
+            stream  = self._fields(stream, self.STREAM_FIELDS)
+            itag    = stream.get("itag", "")
+            url     = stream.get("url")
+            type    = stream.get("type", "")
+            if not url or not formats.has_key(itag) or not type.startswith("video/"):
+                continue
+
+            # e.g. "video/mp4; codecs=..."
+            container = type[6:]
+            extension = self.CONTAINERS.get(container.split(";", 1)[0].strip())
+            if extension not in self.include_formats:
+                continue
+
+            width, height, codec = formats[itag]
+            videos.append({
+                "itag":       itag,
+                "quality":    stream.get("quality", ""),
+                "width":      width,
+                "height":     height,
+                "codec":      codec,
+                "container":  container,
+                "extension":  extension,
+                "url":        url
+            })
+
+        return videos
+
+class Drive(object):
+    PROTOCOL    = 'https://'
+
+    VIDEO_INFO_URL = PROTOCOL+'docs.google.com/get_video_info?docid=%s'
+
+    DISCOVERY_URL = PROTOCOL+'www.googleapis.com/discovery/v1/apis/drive/v2/rest'
+
+    # Fields listed for the children of a batch of folders, including their
+    # parents so that they can be matched to the folders
+    BATCH_FIELDS = ("items(id,mimeType,title,createdDate,modifiedDate,fileSize,videoMediaMetadata,"
+                    "downloadUrl,fileExtension,parents(id,isRoot)),nextPageToken")
+
+    # Stream URLs include the time they expire at, either as a query parameter
+    # or as a path segment
+    EXPIRE_RE   = re.compile(r'[?&/]expire[=/](\d+)')
+
+    def __init__(self, config):
+        self._config    = config
+        self._storage   = Storage(os.path.expanduser(config.get(CONFIG_SECTION, "oath_storage")))
+        self._creds     = self._storage.get()
+        self._flow      = OAuth2WebServerFlow(config.get(CONFIG_SECTION, "client_id"),
+                                              config.get(CONFIG_SECTION, "client_secret"),
+                                              config.get(CONFIG_SECTION, "oauth_scope"),
+                                              redirect_uri=config.get(CONFIG_SECTION, "redirect_uri"))
+        
+        # Each thread needs to have it's own http and service instance.  These
+        # are built from a copy of the API's discovery document, which is only
+        # fetched once.
+        self._clients       = ClientPool(self.build_service,
+                                         config.getint(CONFIG_SECTION, "client_pool_size"),
+                                         config.getint(CONFIG_SECTION, "client_idle_timeout"))
+        self._discovery     = None
+        self._discovery_lock = threading.Lock()
+
+        # All requests get their access token from here
+        self._tokens        = TokenManager(self, config.getint(CONFIG_SECTION, "token_refresh_margin"))
+
+        self.metrics    = Metrics()
+
+        self._tree      = Node('root', 'root', None, self)
+
+        self._parser    = VideoInfoParser(config.get(CONFIG_SECTION, "include_formats"))
+
+        # Indices of loaded nodes by path and by id, maintained as children are
+        # added and removed
+        self._paths         = {}
+        self._ids           = {}
+        self._index_lock    = TimedLock("index", self.metrics)
+        self.index(self._tree)
+
+        # Shared keep-alive connections for video requests
+        self._pool      = ConnectionPool(config.getint(CONFIG_SECTION, "pool_connections"),
+                                         config.getint(CONFIG_SECTION, "pool_idle_timeout"))
+
+        # File and folder data is cache duration, in seconds
+        self.CACHE_TIME = config.getint(CONFIG_SECTION, "cache_duration")
+
+        self.VIDEO_EXTS = set([v.strip() for v in config.get(CONFIG_SECTION, "video_extensions").lower().split(",")])
+
+        # The root folder is cached separately, and can usually be kept longer
+        self.ROOT_CACHE_TIME = config.getint(CONFIG_SECTION, "root_cache")
+
+        # Time, in seconds, past expiry that stale data is still served while it
+        # is refreshed in the background
+        self.MAX_STALE_TIME = config.getint(CONFIG_SECTION, "cache_max_stale")
+
+        # Optionally keep the tree in sync with the changes feed
+        self._changes = None
+        if config.getboolean(CONFIG_SECTION, "sync_changes"):
+            self._changes = ChangeSync(self,
+                                       os.path.expanduser(config.get(CONFIG_SECTION, "changes_state")),
+                                       config.getint(CONFIG_SECTION, "changes_interval"))
+
+        # Optionally persist the tree, so that remounts don't start from scratch
+        self._store = None
+        if config.get(CONFIG_SECTION, "metadata_db"):
+            self._store = MetadataStore(os.path.expanduser(config.get(CONFIG_SECTION, "metadata_db")))
+
+        self._refresher     = WorkerPool("refresh", config.getint(CONFIG_SECTION, "refresh_threads"))
+
+        # Optionally persist the sizes of alternate videos
+        self._sizes = None
+        if config.get(CONFIG_SECTION, "size_cache"):
+            self._sizes = SizeCache(os.path.expanduser(config.get(CONFIG_SECTION, "size_cache")))
+
+        # Threads used to look up the sizes of alternate videos
+        self._lookup_pool   = WorkerPool("lookup", config.getint(CONFIG_SECTION, "lookup_pool_size"))
+
+        # Optionally look up the alternate videos of every video in a folder
+        # once it is listed.  This uses its own threads, as expanding a video
+        # waits on the lookup pool.
+        self.EXPAND_VIDEOS  = config.getboolean(CONFIG_SECTION, "expand_videos")
+        self._expander      = WorkerPool("expand", config.getint(CONFIG_SECTION, "expand_threads"))
+
+        self.metrics.gauge("connection_pool", self._pool.stats)
+        self.metrics.gauge("refresh_pool", self._refresher.stats)
+        self.metrics.gauge("lookup_pool", self._lookup_pool.stats)
+        self.metrics.gauge("expand_pool", self._expander.stats)
+        self.metrics.gauge("loaded_nodes", lambda: len(self._paths))
+        self.metrics.gauge("api_clients", self._clients.stats)
+        if self._sizes:
+            self.metrics.gauge("size_cache", self._sizes.stats)
+        self._refreshing    = set()
+        self._pending       = []
+        self._refresh_lock  = threading.Lock()
+
+        # Maximum number of folders to list at once
+        self.BATCH_FOLDERS  = config.getint(CONFIG_SECTION, "batch_folders")
+
+        # Alternate videos by docid, as ``(expires, videos)`` tuples, and the
+        # nodes of the open streams of each docid
+        self._videos        = {}
+        self._videos_open   = {}
+        self._videos_lock   = threading.Lock()
+
+        # Cookies set by the last video info lookup, which video requests need
+        self._cookies       = ""
+
+        # Time, in seconds, before their URLs expire that alternate videos are
+        # looked up again
+        self.URL_RENEW_MARGIN = config.getint(CONFIG_SECTION, "url_renew_margin")
+
+        # Time, in seconds, to keep alternate videos whose URLs don't expire
+        self.URL_CACHE_TIME   = config.getint(CONFIG_SECTION, "url_cache_time")
+
+    def start(self):
+        """
+        Starts background tasks.  Called once the file system is mounted.
+        """
+        if self._changes:
+            self._changes.start()
+
+        self._tokens.start()
+
+        interval = self._config.getint(CONFIG_SECTION, "prewarm_interval")
+        if interval > 0:
+            t = threading.Thread(target=self._run_prewarm, args=(interval,), name="prewarm")
+            t.daemon = True
+            t.start()
+
+        if self.URL_RENEW_MARGIN > 0:
+            t = threading.Thread(target=self._run_renew_urls, name="renew")
+            t.daemon = True
+            t.start()
+
+    def schedule_refresh(self, node, force=False):
+        """
+        Refreshes ``node`` in the background, unless a refresh of it is already
+        pending.  Unless ``force`` is set, the node is only refreshed if it has
+        expired.  Folders that have been loaded are refreshed in batches.
+        """
+        with self._refresh_lock:
+            if node in self._refreshing:
+                return
+            self._refreshing.add(node)
+
+            if node.updated and not node.attribs.has_key("originalMimeType"):
+                self._pending.append((node, force))
+                node = None
+
+        if node is None:
+            self._refresher.submit(self._background_refresh_pending)
+        else:
+            self._refresher.submit(self._background_refresh, node, force)
+
+    def _background_refresh(self, node, force):
+        try:
+            if force or not node.is_fresh():
+                node.refresh(force)
+        finally:
+            with self._refresh_lock:
+                self._refreshing.discard(node)
+
+    def _background_refresh_pending(self):
+        # Each task refreshes as many pending folders as fit in a batch, so
+        # tasks submitted later may find nothing left to do
+        with self._refresh_lock:
+            batch = self._pending[:self.BATCH_FOLDERS]
+            del self._pending[:self.BATCH_FOLDERS]
+
+        try:
+            nodes = [node for node, force in batch if force or not node.is_fresh()]
+            if nodes:
+                self.refresh_folders(nodes)
+        finally:
+            with self._refresh_lock:
+                for node, force in batch:
+                    self._refreshing.discard(node)
+
+    def refresh_folders(self, nodes):
+        """
+        Refreshes the folders in ``nodes``, listing the children of up to
+        ``batch_folders`` folders per request.  Folders that are being
+        refreshed by another thread are skipped.  Returns the number of folders
+        refreshed.
+        """
+        locked = [node for node in nodes if node._lock.acquire(False)]
+        count  = 0
+        try:
+            for i in range(0, len(locked), self.BATCH_FOLDERS):
+                batch = locked[i:i+self.BATCH_FOLDERS]
+                try:
+                    self._refresh_batch(batch)
+                    count += len(batch)
+                except Exception, e:
+                    log.error("Error listing %d folders: %s" % (len(batch), str(e)))
+        finally:
+            for node in locked:
+                node._lock.release()
+
+        return count
+
+    def _refresh_batch(self, nodes):
+        log.debug("Listing %d folders" % len(nodes))
+
+        items = dict([(node.id, []) for node in nodes])
+        param = {
+            "q":            "(%s) and trashed=false" % " or ".join(["'%s' in parents" % id for id in items]),
+            "fields":       self.BATCH_FIELDS,
+            "maxResults":   1000
+        }
+
+        # All pages are fetched before any folder is updated, so that an error
+        # doesn't leave folders partially listed
+        service = self.get_service()
+        while True:
+            with self.metrics.timer("api.files_list"):
+                files = service.files().list(**param).execute()
+            for item in files.get("items", []):
+                for parent in item.pop("parents", []):
+                    parent_id = "root" if parent.get("isRoot") else parent["id"]
+                    if items.has_key(parent_id):
+                        items[parent_id].append(item)
+
+            param["pageToken"] = files.get("nextPageToken")
+            if not param["pageToken"]:
+                break
+
+        for node in nodes:
+            node._reconcile(items[node.id])
+            node.updated = time.time()
+            node.version += 1
+
+            if self._store:
+                self._store.save(node)
+
+    def expand_videos(self, nodes):
+        """
+        Looks up the alternate videos, and their sizes, of each video in
+        ``nodes`` that hasn't been loaded yet, in the background.
+        """
+        for node in nodes:
+            if node.updated or not node.attribs.has_key("originalMimeType"):
+                continue
+
+            with self._refresh_lock:
+                if node in self._refreshing:
+                    continue
+                self._refreshing.add(node)
+
+            self._expander.submit(self._background_expand, node)
+
+    def _background_expand(self, node):
+        try:
+            if not node.is_fresh():
+                node.refresh()
+            for child in node.children.values():
+                child.lstat()
+        finally:
+            with self._refresh_lock:
+                self._refreshing.discard(node)
+
+    def index(self, node):
+        """
+        Adds ``node``, and any children it has loaded, to the path and id
+        indices.
+        """
+        nodes = [(node, node.get_fs_path())]
+        with self._index_lock:
+            while nodes:
+                node, path = nodes.pop()
+                self._paths[path] = node
+                self._ids.setdefault(node.id, set()).add(node)
+
+                for child in node.children.values():
+                    nodes.append((child, os.path.join(path, child.title)))
+
+    def unindex(self, node):
+        """
+        Removes ``node``, and any children it has loaded, from the path and id
+        indices.  Must be called before the node is detached from its parent.
+        """
+        nodes = [(node, node.get_fs_path())]
+        with self._index_lock:
+            while nodes:
+                node, path = nodes.pop()
+                if self._paths.get(path) is node:
+                    self._paths.pop(path)
+
+                ids = self._ids.get(node.id)
+                if ids is not None:
+                    ids.discard(node)
+                    if not ids:
+                        self._ids.pop(node.id)
+
+                for child in node.children.values():
+                    nodes.append((child, os.path.join(path, child.title)))
+
+    def find_nodes(self, *ids):
+        """
+        Returns all loaded nodes with any of the given ids.
+        """
+        found = []
+        with self._index_lock:
+            for id in ids:
+                found.extend(self._ids.get(id, ()))
+        return found
+
+    def prewarm(self):
+        """
+        Refreshes every folder in the tree that has expired.
+        """
+        log.info("Prewarming folder tree")
+        start   = time.time()
+        count   = 0
+        nodes   = [self._tree]
+
+        # The tree is walked a level at a time, so that the folders of each
+        # level can be listed in batches
+        while nodes:
+            count += self.refresh_folders([node for node in nodes if not node.is_fresh()])
+
+            children = []
+            for node in nodes:
+                for child in node.children.values():
+                    # Videos are presented as folders too, but aren't listed here
+                    if child.attribs.get("mimeType") == Node.FOLDER_MIMETYPE and not child.attribs.has_key("originalMimeType"):
+                        children.append(child)
+            nodes = children
+
+        log.info("Prewarmed %d folders in %.1f seconds" % (count, time.time()-start))
+
+    def _run_prewarm(self, interval):
+        while True:
+            try:
+                self.prewarm()
+            except Exception, e:
+                log.error("Error prewarming folder tree: %s" % str(e))
+            time.sleep(interval)
+
+    def get_http(self):
+        return self._clients.get()[1]
+
+    def get_service(self):
+        return self._clients.get()[0]
+
+    def get_discovery_document(self, http):
+        """
+        Returns the discovery document of the Drive API.  It is read from
+        ``discovery_cache`` if that is recent enough, and otherwise fetched and
+        saved there.  Returns ``None`` if it can't be fetched or read.
+        """
+        with self._discovery_lock:
+            if self._discovery is None:
+                self._discovery = self._load_discovery_document(http)
+            return self._discovery
+
+    def _load_discovery_document(self, http):
+        path    = os.path.expanduser(self._config.get(CONFIG_SECTION, "discovery_cache"))
+        max_age = self._config.getint(CONFIG_SECTION, "discovery_cache_time")
+
+        cached = None
+        if path and os.path.exists(path):
+            with open(path) as f:
+                cached = f.read()
+            if time.time()-os.path.getmtime(path) < max_age:
+                log.debug("Using cached discovery document: %s" % path)
+                return cached
+
+        try:
+            with self.metrics.timer("api.discovery"):
+                status, content = http.request(self.DISCOVERY_URL, "GET")
+            if int(status.get("status", 200)) != 200:
+                raise Exception("HTTP status %s" % status.get("status"))
+            json.loads(content)
+        except Exception, e:
+            # A stale copy is better than nothing
+            log.error("Error fetching discovery document: %s" % str(e))
+            return cached
+
+        if path:
+            try:
+                with open(path + ".tmp", "w") as f:
+                    f.write(content)
+                os.rename(path + ".tmp", path)
+            except (IOError, OSError), e:
+                log.error("Error saving discovery document: %s" % str(e))
+
+        return content
+
+
+    def build_service(self, query=False):
+        if self._creds is not None and self._creds.invalid:
+            self._creds = run(self._flow, self._storage)
+
+        while self._creds is None:
+            print "\nGo to the following URL and copy-paste the code below:\n\n", self._flow.step1_get_authorize_url()
+            try:
+                self._creds = self._flow.step2_exchange(raw_input("\nCode: ").strip())
+                if self._creds:
+                    self._storage.put(self._creds)
+            except FlowExchangeError:
+                print "The code was invalid, please try again"
+
+        # Setup HTTP
+        http = httplib2.Http(timeout=5)
+        self._tokens.authorize(http)
+
+        # Setup the service, from the discovery document if we have it
+        document = self.get_discovery_document(http)
+        if document:
+            service = build_from_document(document, http=http)
+        else:
+            service = build('drive', 'v2', http=http)
+
+        return service, http
+
+    def get_node(self, path):
+        """
+        Returns the node at ``path``, or ``None`` if there isn't one.
+        """
+        segments = full_path_split(path)
+        path     = "/" + "/".join(segments)
+
+        # Most lookups are for nodes that have already been loaded, in which
+        # case only the listing of the parent needs to be checked
+        node = self._paths.get(path)
+        if node is not None:
+            parent = node.parent
+            if parent is None:
+                return node
+
+            parent.update()
+            if parent.children.get(node.title) is node:
+                return node
+
+        # Each node is locked only while it is being refreshed, so unrelated
+        # paths can be walked in parallel
+        node = self._tree
+        for segment in segments:
+            node = node.get_children().get(segment)
+            if node is None:
+                break
+
+        return node
+
+    def list_dir(self, path):
+        node = self.get_node(path)
+        if node:
+            children = node.get_children()
+            if self.EXPAND_VIDEOS:
+                self.expand_videos(children.values())
+            return children
+        return {}
+
+    def get_content_length(self, url):
+        """
+        Returns the size, in bytes, of the video at ``url``.  Only the first byte
+        is requested, so that the connection can be reused afterwards.
+        """
+        for i in range(2):
+            token = self._tokens.get_token()
+            hdrs  = {
+                'Authorization': 'Bearer %s' % token,
+                'Cookie':         self._cookies,
+                'Range':         'bytes=0-0'
+            }
+            try:
+                with self.metrics.timer("http.size_probe"):
+                    res = self._pool.request(url, hdrs)
+                    res.close()
+                break
+            except urllib2.HTTPError, e:
+                if e.code != 401 or i:
+                    raise
+                self.metrics.incr("token_refused")
+                self._tokens.refresh(token)
+
+        # A ranged response includes the full size in "Content-Range", e.g.
+        # "bytes 0-0/1234", otherwise the whole video was returned
+        content_range = res.headers.get("content-range", "")
+        if "/" in content_range:
+            return int(content_range.rsplit("/", 1)[1])
+        return int(res.headers.get("content-length", 0))
+
+    def get_url_expiry(self, videos):
+        """
+        Returns the time at which the first of the URLs in ``videos`` expires.
+        """
+        expires = []
+        for video in videos:
+            match = self.EXPIRE_RE.search(video.get("url", ""))
+            if match:
+                expires.append(int(match.group(1)))
+
+        if expires:
+            return min(expires)
+        return time.time() + self.URL_CACHE_TIME
+
+    def get_urls_for_docid(self, docid, force=False):
+        """
+        Returns the alternate videos for ``docid``.  Videos are looked up once
+        and then reused until shortly before their URLs expire, unless ``force``
+        is set.
+        """
+        with self._videos_lock:
+            entry = self._videos.get(docid)
+
+        if entry is None or force or time.time() >= entry[0] - self.URL_RENEW_MARGIN:
+            self.metrics.incr("video_info.misses")
+            videos = self._fetch_urls_for_docid(docid)
+            if not videos:
+                return []
+
+            entry = (self.get_url_expiry(videos), videos)
+            with self._videos_lock:
+                self._videos[docid] = entry
+
+            # Loaded nodes of this video pick up the new URLs, as do the nodes
+            # of open streams, which may have since been replaced in the tree
+            with self._videos_lock:
+                nodes = set(self._videos_open.get(docid, ()))
+            nodes.update(self.find_nodes(docid))
+
+            urls = dict([(v.get("itag"), v.get("url")) for v in videos])
+            for node in nodes:
+                if node.video_attribs and urls.has_key(node.video_attribs.get("itag")):
+                    node.video_attribs["url"] = urls[node.video_attribs.get("itag")]
+
+        else:
+            self.metrics.incr("video_info.hits")
+
+        # Each caller gets its own copies, which nodes add sizes to
+        return [v.copy() for v in entry[1]]
+
+    def forget_urls(self, docid):
+        with self._videos_lock:
+            self._videos.pop(docid, None)
+
+    def open_video(self, node):
+        """
+        Marks a stream of ``node`` as open, so that its URL is renewed before it
+        expires.
+        """
+        with self._videos_lock:
+            self._videos_open.setdefault(node.id, []).append(node)
+
+    def close_video(self, node):
+        with self._videos_lock:
+            nodes = self._videos_open.get(node.id, [])
+            if node in nodes:
+                nodes.remove(node)
+            if not nodes:
+                self._videos_open.pop(node.id, None)
+
+    def renew_urls(self):
+        """
+        Looks up the alternate videos of open streams whose URLs are about to
+        expire, and forgets those of other videos once they have expired.
+        """
+        now   = time.time()
+        renew = []
+        with self._videos_lock:
+            for docid, (expires, videos) in self._videos.items():
+                if self._videos_open.has_key(docid):
+                    if now >= expires - self.URL_RENEW_MARGIN:
+                        renew.append(docid)
+                elif now >= expires:
+                    self._videos.pop(docid)
+
+        for docid in renew:
+            log.debug("Renewing video URLs for: %s" % docid)
+            self.metrics.incr("url_renewals")
+            self.get_urls_for_docid(docid, force=True)
+
+    def _run_renew_urls(self):
+        # Check often enough that URLs are renewed well within the margin
+        interval = max(self.URL_RENEW_MARGIN // 4, 1)
+        while True:
+            time.sleep(interval)
+            try:
+                self.renew_urls()
+            except Exception, e:
+                log.error("Error renewing video URLs: %s" % str(e))
+
+    def _fetch_urls_for_docid(self, docid):
+        params  = urllib.urlencode({'docid': docid})
+        url     = self.VIDEO_INFO_URL % docid
+        http    = self.get_http()
+
+        for i in range(3):
+            try:
+                with self.metrics.timer("api.get_video_info"):
+                    status, response_data = http.request(url, "GET")
+                self._cookies = status['set-cookie']
+                break
+            except Exception, e:
+                log.error("Error get_urls_for_docid: '%s' ... trying again" % str(e))
+                if i == 2:
+                    log.error("Error get_urls_for_docid: '%s' ... giving up" % str(e))
+                    return []
+
+        return self._parser.parse(response_data)
+
+class BlockCache(object):
+    """
+    A thread-safe, in-memory cache of fixed-size blocks of file data.  Blocks
+    are keyed by ``(docid, variant, mtime, index)`` and the least recently used
+    blocks are evicted once the total size of the cache exceeds ``max_bytes``.
+    """
+
+    def __init__(self, max_bytes, block_size):
+        self.max_bytes  = max_bytes
+        self.block_size = block_size
+        self.size       = 0
+        self.hits       = 0
+        self.misses     = 0
+
+        self._blocks    = collections.OrderedDict()
+        self._lock      = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._blocks.pop(key, None)
+            if data is None:
+                self.misses += 1
+                return None
+
+            # Re-insert the block to mark it as the most recently used
+            self._blocks[key] = data
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._blocks.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+            self._blocks[key] = data
+            self.size += len(data)
+
+            # Evict the least recently used blocks
+            while self.size > self.max_bytes:
+                evicted_key, evicted = self._blocks.popitem(last=False)
+                self.size -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "blocks":   len(self._blocks),
+                "bytes":    self.size,
+                "hits":     self.hits,
+                "misses":   self.misses
+            }
+
+class DiskCache(object):
+    """
+    A persistent cache of blocks of file data, stored as one chunk file per
+    block under ``path``.  The chunks of each variant are kept in a directory
+    named after the modification time of the source file, so that they are
+    invalidated when the file changes.  Once the total size of the cache
+    exceeds ``max_bytes``, the least recently accessed chunks are removed.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path       = path
+        self.max_bytes  = max_bytes
+        self.size       = 0
+        self.hits       = 0
+        self.misses     = 0
+
+        # Map of chunk path to chunk size, ordered by access time
+        self._chunks    = collections.OrderedDict()
+        self._checked   = set()
+        self._lock      = threading.Lock()
+
+        self._load()
+
+    def _load(self):
+        """
+        Builds the index of chunks left over from previous mounts.
+        """
+        chunks = []
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                chunk_path = os.path.join(root, name)
+                try:
+                    if name.endswith(".tmp"):
+                        # Partially written chunk
+                        os.remove(chunk_path)
+                        continue
+                    st = os.stat(chunk_path)
+                except OSError:
+                    continue
+                chunks.append((st.st_atime, chunk_path, st.st_size))
+
+        chunks.sort()
+        for atime, chunk_path, size in chunks:
+            self._chunks[chunk_path] = size
+            self.size += size
+
+        log.info("Loaded %d chunks (%d bytes) from disk cache: %s" % (len(chunks), self.size, self.path))
+
+        with self._lock:
+            self._evict()
+
+    def _get_dir(self, key, mtime):
+        docid, variant = key
+        return os.path.join(self.path, docid, "%s-%d" % (variant, mtime))
+
+    def _remove(self, chunk_path):
+        self.size -= self._chunks.pop(chunk_path, 0)
+        try:
+            os.remove(chunk_path)
+            os.rmdir(os.path.dirname(chunk_path))
+        except OSError:
+            # The directory still contains other chunks
+            pass
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._chunks:
+            chunk_path = next(iter(self._chunks))
+            self._remove(chunk_path)
+
+    def _invalidate(self, key, mtime):
+        """
+        Removes chunks stored for any other modification time of ``key``.
+        """
+        if (key, mtime) in self._checked:
+            return
+        self._checked.add((key, mtime))
+
+        current = self._get_dir(key, mtime)
+        parent  = os.path.dirname(current)
+        prefix  = "%s-" % key[1]
+
+        if not os.path.isdir(parent):
+            return
+
+        for name in os.listdir(parent):
+            stale = os.path.join(parent, name)
+            if name.startswith(prefix) and stale != current:
+                log.info("Removing stale chunks: %s" % stale)
+                for chunk_path in [c for c in self._chunks if os.path.dirname(c) == stale]:
+                    self.size -= self._chunks.pop(chunk_path)
+                shutil.rmtree(stale, True)
+
+    def get(self, key, mtime, index):
+        chunk_path = os.path.join(self._get_dir(key, mtime), str(index))
+
+        with self._lock:
+            self._invalidate(key, mtime)
+
+            if chunk_path not in self._chunks:
+                self.misses += 1
+                return None
+
+            try:
+                with open(chunk_path, "rb") as f:
+                    data = f.read()
+                os.utime(chunk_path, None)
+            except (IOError, OSError), e:
+                log.error("Error reading chunk '%s': %s" % (chunk_path, str(e)))
+                self._remove(chunk_path)
+                self.misses += 1
+                return None
+
+            # Mark as the most recently accessed chunk
+            self._chunks[chunk_path] = self._chunks.pop(chunk_path)
+            self.hits += 1
+            return data
+
+    def put(self, key, mtime, index, data):
+        if len(data) > self.max_bytes:
+            return
+
+        chunk_dir  = self._get_dir(key, mtime)
+        chunk_path = os.path.join(chunk_dir, str(index))
+
+        with self._lock:
+            self._invalidate(key, mtime)
+
+            try:
+                if not os.path.isdir(chunk_dir):
+                    os.makedirs(chunk_dir)
+
+                # Write to a temporary file first so that a partially written
+                # chunk is never read
+                with open(chunk_path+".tmp", "wb") as f:
+                    f.write(data)
+                os.rename(chunk_path+".tmp", chunk_path)
+            except (IOError, OSError), e:
+                log.error("Error writing chunk '%s': %s" % (chunk_path, str(e)))
+                return
+
+            self.size -= self._chunks.pop(chunk_path, 0)
+            self._chunks[chunk_path] = len(data)
+            self.size += len(data)
+
+            self._evict()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "chunks":   len(self._chunks),
+                "bytes":    self.size,
+                "hits":     self.hits,
+                "misses":   self.misses
+            }
+
+class Stream(object):
+    """
+    An open HTTP stream of a node's data, which is read sequentially in blocks.
+
+    Once sequential access is detected, a background thread reads ahead of the
+    reader into a bounded buffer.  The size of the read-ahead window adapts to
+    the rate at which the reader consumes blocks, so that the buffer holds
+    roughly ``readahead_time`` seconds of data.
+
+    If ``download_connections`` is greater than one, the read-ahead instead
+    fetches upcoming segments of the file over that many concurrent ranged
+    requests, and the blocks are handed to the reader in order.
+
+    Small forward seeks, of up to ``seek_window`` bytes, are handled by reading
+    past the skipped data on the open connection rather than reconnecting.  The
+    last ``reorder_blocks`` blocks are kept, so that slightly out of order reads
+    don't look like seeks.
+    """
+
+    # Number of consecutive blocks that must be read before reading ahead
+    SEQUENTIAL_BLOCKS = 2
+
+    # Minimum read-ahead window, in blocks
+    MIN_WINDOW = 2
+
+    # Time, in seconds, that a reader waits for the read-ahead to deliver a
+    # block before reading it itself
+    MAX_WAIT = 30
+
+    def __init__(self, fs, path, node):
+        config = fs.drive._config
+
+        self.fs         = fs
+        self.path       = path
+        self.node       = node
+        self.block_size = fs.cache.block_size
+        self.pos        = None
+
+        self._handle    = None
+        self._io_lock   = TimedLock("stream", fs.metrics)
+        self._cond      = threading.Condition()
+        self._closed    = False
+
+        # Read-ahead state
+        self._readahead     = config.getboolean(CONFIG_SECTION, "readahead")
+        self._ahead_time    = config.getfloat(CONFIG_SECTION, "readahead_time")
+        self._max_window    = max(self.MIN_WINDOW, config.getint(CONFIG_SECTION, "readahead_max")*1024*1024 // self.block_size)
+        self._window        = self.MIN_WINDOW
+        self._buffer        = {}
+        self._threads       = []
+        self._active        = False
+        self._generation    = 0
+        self._next          = None
+        self._fetching      = set()
+        self._eof           = None
+
+        if node.video_attribs and node.video_attribs.get("bytes"):
+            # Don't read ahead past the end of the file
+            self._eof = (node.video_attribs["bytes"]-1) // self.block_size
+
+        # Segmented downloading
+        self._connections   = max(1, config.getint(CONFIG_SECTION, "download_connections"))
+        self._segment       = 1
+        if self._connections > 1:
+            segment_size  = config.getint(CONFIG_SECTION, "download_segment_size")*1024*1024
+            self._segment = max(1, -(-segment_size // self.block_size))
+
+        # Seek handling
+        self._seek_window   = config.getint(CONFIG_SECTION, "seek_window")*1024
+        self._reorder       = config.getint(CONFIG_SECTION, "reorder_blocks")
+        self._recent        = collections.OrderedDict()
+
+        # Access pattern tracking
+        self._last_index    = None
+        self._last_time     = None
+        self._sequential    = 0
+        self._rate          = 0.0
+
+    def _fetch(self, index):
+        """
+        Reads block number ``index`` from the network, re-opening the HTTP
+        stream if it isn't positioned at the start of the block.
+        """
+        offset = index*self.block_size
+
+        with self._io_lock:
+            if self._closed:
+                raise fuse.FuseOSError(errno.EIO)
+
+            if self._handle is not None and self.pos < offset <= self.pos+self._seek_window:
+                # A small skip forward is cheaper to read past than to reconnect
+                self.fs.metrics.incr("stream.seek_skips")
+                self._skip(offset)
+
+            if self._handle is not None and self.pos != offset:
+                # Since the requested position does not match the current position,
+                # a SEEK is required.  However, since we can't seek on the open
+                # handle, we must first close it and then open a new one at the desired
+                # offset using the "Range" header
+                log.debug("Seek required, closing handle: %s", self.path)
+                self.fs.metrics.incr("stream.seek_reconnects")
+                self._close_handle()
+
+            # If we don't have an opened stream, let's try to open one
+            if self._handle is None:
+                log.debug("Opening: %s", self.path)
+                self._handle = self.fs._open_url(self.node, offset)
+                self.pos     = offset
+
+            try:
+                # Get the data
+                data = self._handle.read(self.block_size)
+                amt  = len(data)
+
+                log.debug("Read %d bytes", amt)
+
+                # Keep track of position in opened handle
+                self.pos += amt
+            except Exception, e:
+                log.error("Read error: %s" % str(e))
+                self.fs.metrics.incr("stream.read_errors")
+
+                # TODO: Handle this read error better...
+                self._close_handle()
+
+                # Emulate "I/O error"
+                raise fuse.FuseOSError(errno.EIO)
+
+        return data
+
+    def _skip(self, offset):
+        """
+        Reads forward on the open handle up to ``offset``, keeping the skipped
+        blocks in case they're asked for next.  Must be called with ``_io_lock``
+        held.
+        """
+        log.debug("Skipping forward %d bytes: %s", offset-self.pos, self.path)
+
+        try:
+            while self.pos < offset:
+                index = self.pos // self.block_size
+                data  = self._handle.read(min(self.block_size, offset-self.pos))
+                if not data:
+                    break
+
+                if self.pos % self.block_size == 0 and len(data) == self.block_size:
+                    with self._cond:
+                        self._remember(index, data)
+
+                self.pos += len(data)
+        except Exception, e:
+            log.debug("Error skipping forward: %s", str(e))
+            self._close_handle()
+
+    def _remember(self, index, data):
+        """
+        Keeps a block in the reorder buffer.  Must be called with ``_cond``
+        held.
+        """
+        self._recent.pop(index, None)
+        self._recent[index] = data
+        while len(self._recent) > self._reorder:
+            self._recent.popitem(last=False)
+
+    def _close_handle(self):
+        if self._handle is not None:
+            try:
+                self._handle.close()
+            except Exception, e:
+                log.debug("Error closing handle: %s", str(e))
+            self._handle = None
+
+    def _note_access(self, index, waited):
+        """
+        Tracks the access pattern of the reader and adapts the read-ahead
+        window to the rate at which blocks are consumed.  Must be called with
+        ``_cond`` held.
+        """
+        now = time.time()
+
+        if self._last_index is not None and self._last_index < index <= self._last_index+1+self._reorder:
+            self._sequential += 1
+
+            elapsed = now - self._last_time
+            if elapsed > 0:
+                # Exponentially weighted average of blocks consumed per second
+                rate = 1.0/elapsed
+                self._rate = rate if not self._rate else 0.8*self._rate + 0.2*rate
+
+            window = int(self._rate*self._ahead_time) + 1
+            if waited:
+                # The reader caught up with us, so read further ahead
+                window = max(window, self._window*2)
+            self._window = max(self.MIN_WINDOW, min(self._max_window, window))
+        elif self._last_index != index:
+            self._sequential = 0
+
+        self._last_index = index
+        self._last_time  = now
+
+    def _fetch_segment(self, index, count):
+        """
+        Reads ``count`` blocks starting at block ``index`` over a new ranged
+        request, yielding ``(index, data)`` as each block arrives.
+        """
+        offset = index*self.block_size
+        handle = self.fs._open_url(self.node, offset, offset+count*self.block_size-1)
+
+        try:
+            for i in xrange(index, index+count):
+                data = handle.read(self.block_size)
+                yield i, data
+
+                if len(data) < self.block_size:
+                    break
+        finally:
+            handle.close()
+
+    def _stop_readahead(self):
+        """
+        Must be called with ``_cond`` held.
+        """
+        if self._active:
+            log.debug("Stopping read-ahead: %s", self.path)
+        self._active = False
+        self._generation += 1
+        self._next   = None
+        self._buffer.clear()
+        self._fetching.clear()
+        self._cond.notify_all()
+
+    def _start_readahead(self, index):
+        """
+        Starts reading ahead from block ``index``.  Must be called with
+        ``_cond`` held.
+        """
+        if self._eof is not None and index > self._eof:
+            return
+
+        log.debug("Starting read-ahead at block %d: %s", index, self.path)
+        self._active = True
+        self._next   = index
+
+        # One thread per connection
+        while len(self._threads) < self._connections:
+            thread = threading.Thread(target=self._run_readahead)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        self._cond.notify_all()
+
+    def _deliver(self, index, data, generation):
+        """
+        Hands a block read ahead to the reader.  Must be called with ``_cond``
+        held.
+        """
+        if generation != self._generation:
+            # The read-ahead has since been stopped or restarted elsewhere
+            return
+
+        self._fetching.discard(index)
+        self._buffer[index] = data
+
+        if len(data) < self.block_size:
+            # Reached the end of the file
+            self._eof    = index
+            self._active = False
+
+        self._cond.notify_all()
+
+    def _run_readahead(self):
+        while True:
+            with self._cond:
+                while not self._closed and (not self._active or
+                        (self._eof is not None and self._next > self._eof) or
+                        len(self._buffer)+len(self._fetching) >= max(self._window, self._connections*self._segment)):
+                    self._cond.wait()
+
+                if self._closed:
+                    return
+
+                index       = self._next
+                count       = self._segment
+                generation  = self._generation
+
+                self._next += count
+                self._fetching.update(xrange(index, index+count))
+
+            try:
+                if self._connections > 1:
+                    for i, data in self._fetch_segment(index, count):
+                        with self._cond:
+                            if generation != self._generation:
+                                # No longer needed
+                                break
+                            self._deliver(i, data, generation)
+                else:
+                    data = self._fetch(index)
+                    with self._cond:
+                        self._deliver(index, data, generation)
+            except Exception, e:
+                log.debug("Read-ahead failed: %s", str(e))
+                with self._cond:
+                    if generation == self._generation:
+                        self._stop_readahead()
+                continue
+
+            with self._cond:
+                if generation == self._generation:
+                    # Blocks past the end of the file will never arrive
+                    self._fetching.difference_update(xrange(index, index+count))
+                    self._cond.notify_all()
+
+    def _release_skipped(self, index):
+        """
+        Moves blocks before ``index`` out of the read-ahead buffer, so that they
+        don't hold up the read-ahead.  Must be called with ``_cond`` held.
+        """
+        # Blocks that were skipped over may still be read out of order
+        for skipped in sorted(i for i in self._buffer if i < index):
+            self._remember(skipped, self._buffer.pop(skipped))
+
+    def cached(self, index, data):
+        """
+        Tells the stream that block ``index`` was served from a cache instead,
+        so that the read-ahead moves on as if it had been read from the stream.
+        """
+        with self._cond:
+            self._buffer.pop(index, None)
+            self._release_skipped(index)
+
+            if self._active and index >= self._next:
+                self._next = index+1
+
+            self._note_access(index, False)
+            self._remember(index, data)
+            self._cond.notify_all()
+
+    def read_block(self, index):
+        waited   = False
+        deadline = time.time() + self.MAX_WAIT
+
+        with self._cond:
+            if self._eof is not None and index > self._eof:
+                # The read-ahead never fetches past the end of the file
+                return ""
+
+            while True:
+                self._release_skipped(index)
+
+                if index in self._buffer:
+                    data = self._buffer.pop(index)
+
+                    self._note_access(index, waited)
+                    self._remember(index, data)
+                    self._cond.notify_all()
+                    return data
+
+                if index in self._recent:
+                    # An out of order read of a recent block
+                    return self._recent[index]
+
+                remaining = deadline - time.time()
+                if self._active and (index in self._fetching or index == self._next) and remaining > 0:
+                    # A read-ahead thread is about to deliver this block
+                    waited = True
+                    self._cond.wait(remaining)
+                    continue
+
+                break
+
+            # This block isn't being read ahead, so read it ourselves
+            self._stop_readahead()
+            self._note_access(index, waited)
+
+        data = self._fetch(index)
+
+        with self._cond:
+            self._remember(index, data)
+
+            if len(data) < self.block_size:
+                self._eof = index
+            elif self._readahead and self._sequential >= self.SEQUENTIAL_BLOCKS-1 and not self._active:
+                self._start_readahead(index+1)
+
+        return data
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._stop_readahead()
+
+        with self._io_lock:
+            self._close_handle()
+
+        for thread in self._threads:
+            thread.join(1)
+
+class NegativeCache(object):
+    """
+    A bounded cache of paths that are known not to exist.  Entries expire after
+    ``ttl`` seconds, or as soon as the children of the parent folder change.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries    = max_entries
+        self.ttl            = ttl
+        self.hits           = 0
+        self.misses         = 0
+
+        self._entries       = collections.OrderedDict()
+        self._lock          = threading.Lock()
+
+    def get(self, path):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                expires, parent, version = entry
+                if time.time() < expires and (parent is None or parent.version == version):
+                    self.hits += 1
+                    return True
+                self._entries.pop(path)
+
+            self.misses += 1
+            return False
+
+    def put(self, path, parent):
+        if self.max_entries <= 0:
+            return
+
+        with self._lock:
+            self._entries.pop(path, None)
+            self._entries[path] = (time.time()+self.ttl, parent, parent.version if parent else None)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries":  len(self._entries),
+                "hits":     self.hits,
+                "misses":   self.misses
+            }
+
+class SizeCache(object):
+    """
+    Persists the sizes of alternate videos in a SQLite database.  Sizes are
+    keyed by ``(docid, itag, modified)``, where ``modified`` is the modification
+    time of the original video, so they only need to be looked up again when
+    the video changes.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sizes (
+            docid       TEXT,
+            itag        TEXT,
+            modified    INTEGER,
+            size        INTEGER,
+            PRIMARY KEY (docid, itag)
+        );
+    """
+
+    def __init__(self, path):
+        self.path   = path
+        self.hits   = 0
+        self.misses = 0
+
+        self._db    = sqlite3.connect(path, check_same_thread=False)
+        self._lock  = threading.Lock()
+
+        with self._lock:
+            self._db.executescript(self.SCHEMA)
+
+    def get(self, docid, itag, modified):
+        with self._lock:
+            row = self._db.execute("SELECT size FROM sizes WHERE docid = ? AND itag = ? AND modified = ?",
+                                   (docid, itag, modified)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return row[0]
+
+    def put(self, docid, itag, modified, size):
+        # Any size stored for an older version of the video is replaced
+        self.put_many([(docid, itag, modified, size)])
+
+    def put_many(self, rows):
+        with self._lock:
+            with self._db:
+                self._db.executemany("INSERT OR REPLACE INTO sizes VALUES (?, ?, ?, ?)", rows)
+
+    def export_sizes(self, f):
+        """
+        Writes all stored sizes to the file object ``f``, as JSON.
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT docid, itag, modified, size FROM sizes").fetchall()
+        json.dump([list(row) for row in rows], f)
+        return len(rows)
+
+    def import_sizes(self, f):
+        """
+        Stores all sizes read from the file object ``f``, as written by
+        ``export_sizes``.
+        """
+        rows = [tuple(row) for row in json.load(f)]
+        self.put_many(rows)
+        return len(rows)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits":     self.hits,
+                "misses":   self.misses
+            }
+
+class GDVFS(fuse.Operations):
+    # Virtual directory of files for inspecting the running file system
+    CONTROL_DIR = "/.gdvfs"
+
+    # Time, in seconds, that the kernel caches file attributes for by default
+    ATTR_TIMEOUT = 1.0
+
+    def __init__(self, drive):
+        self.drive  = drive
+        self.cache  = BlockCache(drive._config.getint(CONFIG_SECTION, "cache_memory")*1024*1024,
+                                 drive._config.getint(CONFIG_SECTION, "cache_block_size")*1024)
+
+        # Optional on-disk cache, which survives remounts
+        self.disk_cache = None
+        cache_dir = drive._config.get(CONFIG_SECTION, "cache_dir")
+        if cache_dir:
+            self.disk_cache = DiskCache(os.path.expanduser(cache_dir),
+                                        drive._config.getint(CONFIG_SECTION, "cache_disk_size")*1024*1024)
+
+        # Paths that are known not to exist, and patterns of names that are
+        # never looked up
+        self.negative = NegativeCache(drive._config.getint(CONFIG_SECTION, "negative_cache_size"),
+                                      drive._config.getint(CONFIG_SECTION, "negative_cache_time"))
+        self.ignore_patterns = [p.strip() for p in drive._config.get(CONFIG_SECTION, "ignore_patterns").split(",") if p.strip()]
+
+        # Map of file handle number to the ``Stream`` opened for it.  Each
+        # handle has its own stream and position, so that multiple readers of
+        # the same file don't interfere with each other.
+        self.opened         = {}
+        self._opened_lock   = threading.Lock()
+        self._next_fh       = 1
+
+        self.metrics = drive.metrics
+        self.metrics.gauge("open_handles", lambda: len(self.opened))
+        self.metrics.gauge("memory_cache", self.cache.stats)
+        self.metrics.gauge("negative_cache", self.negative.stats)
+        if self.disk_cache:
+            self.metrics.gauge("disk_cache", self.disk_cache.stats)
+
+        profile_dir = drive._config.get(CONFIG_SECTION, "profile_dir")
+        self.profiler = Profiler(self.metrics,
+                                 drive._config.getint(CONFIG_SECTION, "profile_duration"),
+                                 drive._config.getint(CONFIG_SECTION, "profile_interval")/1000.0,
+                                 os.path.expanduser(profile_dir) if profile_dir else None)
+
+        # Operations taking longer than this, in seconds, are logged
+        self.slow_op_threshold = drive._config.getint(CONFIG_SECTION, "slow_op_threshold")/1000.0
+
+        # Files in ``CONTROL_DIR``, by name, and the functions that render them.
+        # Opening a file also calls its function in ``control_triggers``.
+        self.control_files  = {
+            "stats":    self.metrics.to_json,
+            "stacks":   format_stacks,
+            "profile":  self.profiler.get_report
+        }
+        self.control_triggers = {
+            "profile":  self.profiler.start
+        }
+        self.mounted        = time.time()
+
+        # The last rendering of each control file by ``getattr``, as ``(time,
+        # data)``, which is what is read when the file is opened straight
+        # after, so that the contents match the size the kernel was told
+        self._control_renders = {}
+
+    # Disable unused operations
+    flush       = None
+    opendir     = None
+    releasedir  = None
+    statfs      = None
+    chmod       = None
+    chown       = None
+    access      = None
+
+    def __call__(self, op, *args):
+        # Every operation is timed, and errors are counted by their error code
+        start = time.time()
+        try:
+            return super(GDVFS, self).__call__(op, *args)
+        except fuse.FuseOSError, e:
+            self.metrics.incr("fuse.%s.%s" % (op, errno.errorcode.get(e.errno, e.errno)))
+            raise
+        finally:
+            elapsed = time.time()-start
+            self.metrics.observe("fuse." + op, elapsed)
+            if self.slow_op_threshold and elapsed > self.slow_op_threshold:
+                log.warning("Slow operation: %s%r took %.3f seconds", op, args[:3], elapsed)
+
+    def _get_control_file(self, path):
+        """
+        Returns the function rendering the control file at ``path``, or
+        ``None`` if ``path`` isn't a control file.
+        """
+        head, tail = os.path.split(path)
+        if head == self.CONTROL_DIR:
+            return self.control_files.get(tail)
+        return None
+
+    def _render_control_file(self, path, render):
+        """
+        Returns the contents of the control file at ``path`` for a new handle.
+        """
+        rendered = self._control_renders.get(path)
+        if rendered is not None and time.time()-rendered[0] < self.ATTR_TIMEOUT:
+            return rendered[1]
+        return render()
+
+    def _control_stat(self, mode, size):
+        return {
+            "st_atime": self.mounted,
+            "st_gid":   os.getgid(),
+            "st_uid":   os.getuid(),
+            "st_mode":  mode,
+            "st_mtime": self.mounted,
+            "st_size":  size
+        }
+
+    def _run_metrics_export(self, path, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.metrics.export(path)
+            except Exception, e:
+                log.error("Error exporting metrics: %s" % str(e))
+
+    def _remove_handle(self, fh):
+        with self._opened_lock:
+            stream = self.opened.pop(fh, None)
+        if stream is not None:
+            stream.close()
+            if stream.node is not None and stream.node.video_attribs:
+                self.drive.close_video(stream.node)
+
+    def listxattr(self, path):
+        return ["user.url", "user.cookie"]
+
+    def getxattr(self, path, name):
+        node = self.drive.get_node(path)
+        if node:
+            if name == "user.url":
+                for i in range(3):
+                    try:
+                        return node.get_video_url()
+                    except:
+                        node.refresh_url()
+            elif name == "user.cookie":
+                return self.drive._cookies
+        return ""
+
+    def _open_url(self, node, offset, end=None):
+        """
+        Opens the stream URL for ``node`` starting at ``offset``.  If ``end``
+        is given, only the bytes up to and including ``end`` are requested.
+        """
+        #   a) try again, or
+        #   b) check to see if a new URL needs to be generated
+        for i in range(2):
+            try:
+                url   = node.get_video_url()
+                token = self.drive._tokens.get_token()
+                hdrs  = {
+                    'Authorization': 'Bearer %s' % token,
+                    'Cookie':         self.drive._cookies,
+                    'Range':         'bytes=%d-%s' % (offset, end if end is not None else '')}
+                with self.metrics.timer("http.video_open"):
+                    return self.drive._pool.request(url, hdrs)
+            except urllib2.HTTPError, e:
+                if e.code == 403:
+                    # Looks like this URL is stale, we need to get a new one
+                    log.info("Video URL has expired...trying to get new one")
+                    self.metrics.incr("url_refreshes")
+
+                    node.refresh_url()
+
+                    # Try again
+                    continue
+                elif e.code == 401:
+                    # The access token has expired
+                    self.metrics.incr("token_refused")
+                    self.drive._tokens.refresh(token)
+                    continue
+                elif e.code == 416:
+                    # There's no data at or past the end of the file
+                    return StringIO.StringIO("")
+            except Exception, e:
+                log.error("Error opening url: %s" % str(e))
+
+            # Give up
+            raise fuse.FuseOSError(errno.EIO)
+
+        raise fuse.FuseOSError(errno.EIO)
+
+    def _get_block(self, stream, index):
+        """
+        Returns block number ``index`` of the stream's node, checking the memory
+        cache and then the disk cache before reading from the stream itself.
+        """
+        node  = stream.node
+        key   = node.get_cache_key()
+        mtime = node.get_modified_time()
+
+        # Blocks of a replaced file must not be mixed with the new ones
+        block = self.cache.get(key + (mtime, index))
+        if block is not None:
+            stream.cached(index, block)
+            return block
+
+        if self.disk_cache:
+            block = self.disk_cache.get(key, mtime, index)
+            if block is not None:
+                self.cache.put(key + (mtime, index), block)
+                stream.cached(index, block)
+                return block
+
+        block = stream.read_block(index)
+        self.cache.put(key + (mtime, index), block)
+        if self.disk_cache:
+            self.disk_cache.put(key, mtime, index, block)
+
+        return block
+
+    def open(self, path, flags):
+        log.debug("open: %s", path)
+
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            raise fuse.FuseOSError(errno.EROFS)
+
+        render = self._get_control_file(path)
+        if render is not None:
+            data = self._render_control_file(path, render)
+
+            trigger = self.control_triggers.get(os.path.basename(path))
+            if trigger is not None:
+                trigger()
+
+            with self._opened_lock:
+                fh = self._next_fh
+                self._next_fh += 1
+                self.opened[fh] = ControlFile(data)
+            return fh
+
+        node = self.drive.get_node(path)
+        if node is None:
+            raise fuse.FuseOSError(errno.ENOENT)
+
+        with self._opened_lock:
+            fh = self._next_fh
+            self._next_fh += 1
+            self.opened[fh] = Stream(self, path, node)
+
+        if node.video_attribs:
+            # Keep the stream's URL from expiring while it is open
+            self.drive.open_video(node)
+
+            # Nodes loaded from the metadata store have URLs from a previous
+            # mount, which have most likely expired, so look them up again
+            # unless that has already been done since mounting
+            self.drive.get_urls_for_docid(node.id)
+
+        return fh
+
+    def read(self, path, length, offset, fh):
+        log.debug("read: %s:%d -> %d +%d", path, fh, offset, length)
+
+        stream = self.opened.get(fh)
+        if stream is None:
+            raise fuse.FuseOSError(errno.EBADF)
+
+        if stream.node is None:
+            # A control file
+            return stream.read(length, offset)
+
+        # Reads are served in whole blocks, which are cached so that repeated
+        # reads of the same region don't need to go back to the network
+        block_size  = self.cache.block_size
+        first       = offset // block_size
+        last        = (offset+length-1) // block_size
+        blocks      = []
+
+        size = stream.node.video_attribs and stream.node.video_attribs.get("bytes")
+        if size:
+            # Don't ask for blocks past the end of the file
+            last = min(last, (size-1) // block_size)
+
+        for index in xrange(first, last+1):
+            block = self._get_block(stream, index)
+            blocks.append(block)
+
+            if len(block) < block_size:
+                # Reached the end of the file
+                break
+
+        start = offset - first*block_size
+        return "".join(blocks)[start:start+length]
+
+    def release(self, path, fh):
+        log.debug("release: %s:%d", path, fh)
+        self._remove_handle(fh)
+
+    def init(self, path):
+        self.drive.start()
+
+        metrics_file = self.drive._config.get(CONFIG_SECTION, "metrics_file")
+        if metrics_file:
+            t = threading.Thread(target=self._run_metrics_export, name="metrics",
+                                 args=(os.path.expanduser(metrics_file),
+                                       self.drive._config.getint(CONFIG_SECTION, "metrics_interval")))
+            t.daemon = True
+            t.start()
+
+    def destroy(self, path):
+        log.info("Memory cache: %s" % self.cache.stats())
+        log.info("Negative cache: %s" % self.negative.stats())
+        if self.drive._sizes:
+            log.info("Size cache: %s" % self.drive._sizes.stats())
+        if self.disk_cache:
+            log.info("Disk cache: %s" % self.disk_cache.stats())
+        log.info("Connection pool: %s" % self.drive._pool.stats())
+        log.info("Refresh pool: %s" % self.drive._refresher.stats())
+        log.info("Lookup pool: %s" % self.drive._lookup_pool.stats())
+        log.info("Expand pool: %s" % self.drive._expander.stats())
+
+        metrics_file = self.drive._config.get(CONFIG_SECTION, "metrics_file")
+        if metrics_file:
+            self.metrics.export(os.path.expanduser(metrics_file))
+
+    def _is_ignored(self, name):
+        for pattern in self.ignore_patterns:
+            if fnmatch.fnmatch(name, pattern):
+                return True
+        return False
+
+    def readdir(self, path, fh):
+        log.debug("readdir: %s", path)
+        if path == self.CONTROL_DIR:
+            return ['.', '..'] + self.control_files.keys()
+
+        # Ignored files are hidden, so that listings agree with getattr
+        names = self.drive.list_dir(path).keys()
+        if self.ignore_patterns:
+            names = [n for n in names if not self._is_ignored(n)]
+        return ['.', '..'] + names
+
+    def getattr(self, path, fh=None):
+        log.debug("getattr: %s", path)
+
+        head, tail = os.path.split(path)
+        if self._is_ignored(tail):
+            raise fuse.FuseOSError(errno.ENOENT)
+
+        if path == self.CONTROL_DIR:
+            return self._control_stat(0o40555, Node.FOLDER_BYTES)
+
+        render = self._get_control_file(path)
+        if render is not None:
+            handle = self.opened.get(fh) if fh is not None else None
+            if isinstance(handle, ControlFile):
+                data = handle.data
+            else:
+                data = render()
+                self._control_renders[path] = (time.time(), data)
+            return self._control_stat(0o100444, len(data))
+
+        if self.negative.get(path):
+            log.debug("Known unknown path: %s", path)
+            raise fuse.FuseOSError(errno.ENOENT)
+
+        node = self.drive.get_node(path)
+        if node:
+            # Regular file or folder, or the root directory
+            return node.lstat()
+
+        log.debug("Unknown path: %s", path)
+        self.negative.put(path, self.drive.get_node(head))
+        raise fuse.FuseOSError(errno.ENOENT)
+
+def setup_logging(config, foreground):
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter())
+
+    debug = config.getboolean(CONFIG_SECTION, "debug")
+
+    log.setLevel(logging.DEBUG)
+
+    if debug or foreground:
+        stream_handler.setLevel(logging.DEBUG)
+    else:
+        stream_handler.setLevel(logging.INFO)
+
+    log.addHandler(stream_handler)
+
+    if config.has_option(CONFIG_SECTION, "log_path"):
+        file_handler = logging.FileHandler(config.get(CONFIG_SECTION, "log_path"))
+        file_handler.setLevel(logging.DEBUG)
+        file_handler.setFormatter(logging.Formatter("[%(levelname)-8s] [%(name)s] %(msg)s"))
+        log.addHandler(file_handler)
+
+
+def usage():
+    print "Usage:\n"
+    print "  %s [options]" % os.path.basename(sys.argv[0])
+    print "\nOptions:\n"
+    print "  -a (--auth)        : Perform OAuth authentication with Google"
+    print "  -f (--foreground)  : Run in the foreground (don't daemonize)"
+    print "  -c (--config=)     : Path to config file (Default: ~/.gdvfs)"
+    print "  --export-sizes=    : Export the video size cache to a file, and exit"
+    print "  --import-sizes=    : Import the video size cache from a file, and exit"
+    print "  -h (--help)        : Print out this help information"
+    print "\n"
+
+def main():
+    print "gdvfs version %s, Copyright (C) %s\n" % (__version__, __author__)
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "afhc:", ["foreground", "help", "config=",
+                                                           "export-sizes=", "import-sizes="])
+    except getopt.GetoptError as err:
+        # print help information and exit:
+        print str(err) # will print something like "option -a not recognized"
+        usage()
+        sys.exit(2)
+
+    config_paths = ["./gdvfs.conf", "~/.gdvfs.conf"]
+    foreground   = False
+    do_auth      = False
+    export_sizes = None
+    import_sizes = None
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-c", "--config"):
+            config_paths.insert(0, a)
+        elif o in ("-f", "--foreground"):
+            foreground = True
+        elif o in ("-a", "--auth"):
+            do_auth = True
+        elif o == "--export-sizes":
+            export_sizes = a
+        elif o == "--import-sizes":
+            import_sizes = a
+
+    config          = ConfigParser.SafeConfigParser(CONFIG_DEFAULT)
+    config_paths    = [os.path.expanduser(pth) for pth in config_paths]
+    loaded_configs  = config.read(config_paths)
+
+    setup_logging(config, foreground)
+
+    log.debug("Loaded config from: %s" % str(loaded_configs))
+
+    drive = Drive(config)
+
+    if export_sizes or import_sizes:
+        if not drive._sizes:
+            print "The size cache is not enabled, set `size_cache` in the config"
+            sys.exit(1)
+
+        if export_sizes:
+            with open(export_sizes, "w") as f:
+                print "Exported %d sizes to: %s" % (drive._sizes.export_sizes(f), export_sizes)
+        if import_sizes:
+            with open(import_sizes) as f:
+                print "Imported %d sizes from: %s" % (drive._sizes.import_sizes(f), import_sizes)
+        return
 
     if do_auth:
         print "Attempting OAuth authentication"